@@ -0,0 +1,56 @@
+# coding=utf-8
+"""
+Import time benchmark and regression guard for the daqflex package.
+
+Imports daqflex in fresh interpreters, reports the best import time and
+checks that no heavy dependency (PyUSB, numpy, pkg_resources) is loaded
+before a device is opened. Exits with status 1 if a heavy module is
+imported or the import takes longer than the limit.
+
+Usage: python benchmarks/bench_import.py [limit_ms] [runs]
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+HEAVY_MODULES = ['usb', 'numpy', 'pkg_resources']
+
+PROBE = """
+import sys, time
+t_0 = time.perf_counter()
+import daqflex
+t_1 = time.perf_counter()
+print((t_1 - t_0) * 1e3)
+print(' '.join(m for m in {0!r} if m in sys.modules))
+""".format(HEAVY_MODULES)
+
+
+def measure():
+    """Import daqflex in a new interpreter, return (ms, heavy modules)."""
+    out = subprocess.check_output([sys.executable, '-c', PROBE], cwd=ROOT,
+                                  universal_newlines=True).splitlines()
+    return float(out[0]), out[1].split() if len(out) > 1 else []
+
+
+def main():
+    limit = float(sys.argv[1]) if len(sys.argv) > 1 else 50.0
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    results = [measure() for _ in range(runs)]
+    best = min(ms for ms, _ in results)
+    loaded = sorted(set(m for _, mods in results for m in mods))
+    print("import daqflex: best {0:.1f} ms of {1} runs (limit {2:.0f} ms)"
+          .format(best, runs, limit))
+    if loaded:
+        print("FAIL: heavy modules loaded at import: " + ", ".join(loaded))
+        return 1
+    if best > limit:
+        print("FAIL: import time above limit")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
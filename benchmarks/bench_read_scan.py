@@ -0,0 +1,108 @@
+# coding=utf-8
+"""
+Benchmark of MCCDevice.read_scan_data against the previous per-packet
+read loop, using an endpoint that delivers a finite scan with a fixed per-call
+latency (emulating the cost of one USB request). This measures the
+per-call and allocation overhead of the read path.
+
+Usage: python benchmarks/bench_read_scan.py [samples] [latency_us]
+"""
+
+import array
+import errno
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import usb.core
+import daqflex
+
+
+class FiniteScanEndpoint(object):
+    """Bulk endpoint returning a fixed number of samples, then timeouts."""
+    wMaxPacketSize = 512
+
+    def __init__(self, samples, latency=50e-6):
+        self.latency = latency
+        self._data = (array.array('H', range(1 << 16)) *
+                      (samples // (1 << 16) + 1))[:samples].tobytes()
+        self._pos = 0
+        self.reads = 0
+
+    def _take(self, size):
+        self.reads += 1
+        t_end = time.time() + self.latency
+        while time.time() < t_end:
+            pass
+        if self._pos >= len(self._data):
+            raise usb.core.USBError('timeout', errno=errno.ETIMEDOUT)
+        # the device sends whole packets only
+        size -= size % self.wMaxPacketSize
+        chunk = self._data[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk
+
+    def read(self, size, timeout):
+        return array.array('B', self._take(size))
+
+    def readinto(self, view, timeout):
+        chunk = self._take(len(view))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class BenchDevice(daqflex.USB_1608G):
+    """Device stub around the simulated endpoint."""
+
+    def __init__(self, samples, latency):
+        self._ep_in = FiniteScanEndpoint(samples, latency)
+        self._bulk_packet_size = self._ep_in.wMaxPacketSize
+
+    def send_message(self, message):
+        return 'AISCAN:STATUS=IDLE'
+
+    def legacy_read_scan_data(self, length, rate):
+        """The read loop before the block-mode engine, one packet per read."""
+        timeout = int(self._bulk_packet_size * 1e3 / 2 / rate) + 10
+        data = array.array('H')
+        while True:
+            packet = None
+            try:
+                packet = self._ep_in.read(self._bulk_packet_size, timeout)
+            except usb.core.USBError as err:
+                if err.errno != errno.ETIMEDOUT:
+                    raise err
+            if (packet is None) or (len(packet) == 0):
+                break
+            data.frombytes(packet)
+            if len(data) >= length:
+                break
+        return data
+
+
+def run(method, samples, latency):
+    dev = BenchDevice(samples, latency)
+    t_start = time.time()
+    data = getattr(dev, method)(samples, 500000)
+    elapsed = time.time() - t_start
+    return elapsed, dev._ep_in.reads, len(data)
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    latency = float(sys.argv[2]) * 1e-6 if len(sys.argv) > 2 else 50e-6
+    print("finite scan of {0} samples, {1:.0f} us per read call".format(
+        samples, latency * 1e6))
+    print("{0:<24} {1:>10} {2:>8} {3:>10}".format(
+        "method", "time [ms]", "reads", "samples"))
+    for method in ['legacy_read_scan_data', 'read_scan_data']:
+        elapsed, reads, count = min(run(method, samples, latency)
+                                     for _ in range(3))
+        print("{0:<24} {1:>10.1f} {2:>8} {3:>10}".format(
+            method, elapsed * 1e3, reads, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# coding=utf-8
+"""
+Throughput and latency benchmark suite running against the device
+simulator, so it needs no hardware.
+
+For each hot path the suite reports:
+
+* time per call (command round trip or conversion of one block)
+* sustained samples/s
+* CPU time per sample of the whole process, excluding the time the
+  simulator spends generating samples
+* net memory blocks left allocated per 1000 samples and the peak of
+  traced memory, measured in a second run under tracemalloc (CPython
+  exposes no count of transient allocations; the peak reflects them)
+
+Usage: python benchmarks/bench_suite.py [rate] [seconds]
+"""
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import daqflex
+from daqflex.simulator import open_simulated
+
+
+class Measurement(object):
+    """Wall clock, CPU and allocation counters of one benchmark run."""
+
+    def __init__(self, dev=None, trace=False):
+        self.sim = dev.dev if dev is not None else None
+        self.trace = trace
+        self.blocks = None
+        self.peak = None
+
+    def __enter__(self):
+        gc.collect()
+        if self.trace:
+            tracemalloc.start()
+            self._blocks = sys.getallocatedblocks()
+        self._signal = self.sim.signal_time if self.sim else 0.0
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+        if self.sim:
+            self.cpu -= self.sim.signal_time - self._signal
+        if self.trace:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            self.blocks = sys.getallocatedblocks() - self._blocks
+            tracemalloc.stop()
+
+
+def bench_commands(calls):
+    """Round trip of send_message, uncached and cached."""
+    results = []
+    for cached in [False, True]:
+        dev = open_simulated(daqflex.USB_1608G, cache_responses=cached)
+        name = 'send_message' + (' (cached)' if cached else '')
+        for trace in [False, True]:
+            with Measurement(dev, trace) as meas:
+                for _ in range(calls):
+                    dev.send_message('?AI{0}:SLOPE')
+            if not trace:
+                timing = meas
+        results.append((name, timing.wall / calls, None, timing.cpu / calls,
+                        meas.blocks / float(calls), meas.peak))
+    return results
+
+
+def bench_calibration(samples):
+    """Conversion of a block of raw samples to voltages."""
+    dev = open_simulated(daqflex.USB_1608G)
+    raw = numpy.arange(samples, dtype=numpy.uint16)
+    conv = dev.get_scan_calibration([0], [(-10, 10)])
+    out = numpy.empty(samples)
+    # the first call allocates the scratch arrays
+    conv.convert(raw, out=out)
+    results = []
+    paths = [
+        ('scale_and_calibrate_data',
+         lambda: dev.scale_and_calibrate_data(raw, -10, 10, (1.0, 0.0))),
+        ('ScanCalibration.convert', lambda: conv.convert(raw)),
+        ('ScanCalibration (out)', lambda: conv.convert(raw, out=out)),
+    ]
+    for name, func in paths:
+        for trace in [False, True]:
+            with Measurement(None, trace) as meas:
+                func()
+            if not trace:
+                timing = meas
+        results.append((name, timing.wall, samples / timing.wall,
+                        timing.cpu / samples, meas.blocks * 1e3 / samples,
+                        meas.peak))
+    return results
+
+
+def run_block(dev, rate, seconds):
+    samples = int(rate * seconds)
+    dev.send_message('AISCAN:SAMPLES={0}'.format(samples))
+    dev.send_message('AISCAN:RATE={0}'.format(rate))
+    dev.send_message('AISCAN:START')
+    return len(dev.read_scan_data(samples, rate))
+
+
+def run_continuous(dev, rate, seconds, queue_depth):
+    dev.send_message('AISCAN:SAMPLES=0')
+    dev.send_message('AISCAN:RATE={0}'.format(rate))
+    dev.start_continuous_transfer(rate, 100, queue_depth=queue_depth)
+    dev.send_message('AISCAN:START')
+    count = 0
+    t_end = time.time() + seconds
+    while time.time() < t_end:
+        count += len(dev.get_new_bulk_data(wait=True))
+    dev.stop_continuous_transfer()
+    dev.send_message('AISCAN:STOP')
+    return count + len(dev.get_new_bulk_data())
+
+
+def bench_acquisition(rate, seconds):
+    """Sustained acquisition through each transfer path."""
+    paths = [
+        ('read_scan_data', lambda dev: run_block(dev, rate, seconds)),
+        ('PollingThread', lambda dev: run_continuous(dev, rate, seconds,
+                                                     None)),
+        ('AsyncBulkReader(4)', lambda dev: run_continuous(dev, rate, seconds,
+                                                          4)),
+    ]
+    results = []
+    for name, func in paths:
+        for trace in [False, True]:
+            dev = open_simulated(daqflex.USB_1608G, fifo_size=1 << 20)
+            with Measurement(dev, trace) as meas:
+                count = func(dev)
+            if not trace:
+                timing, samples = meas, count
+        results.append((name, timing.wall, samples / timing.wall,
+                        timing.cpu / samples, meas.blocks * 1e3 / count,
+                        meas.peak))
+    return results
+
+
+def main():
+    rate = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    print("rate = {0} S/s, {1} s per acquisition run".format(rate, seconds))
+    print("{0:<26} {1:>12} {2:>12} {3:>12} {4:>12} {5:>10}".format(
+        "path", "time [us]", "samples/s", "CPU [ns/S]", "blocks/kS",
+        "peak [KiB]"))
+    results = bench_commands(10000) + bench_calibration(1 << 20) + \
+        bench_acquisition(rate, seconds)
+    for name, wall, throughput, cpu, blocks, peak in results:
+        print("{0:<26} {1:>12.1f} {2:>12} {3:>12.1f} {4:>12.2f} "
+              "{5:>10.1f}".format(
+                  name, wall * 1e6,
+                  '-' if throughput is None else '{0:.0f}'.format(throughput),
+                  cpu * 1e9, blocks, peak / 1024.0))
+    print("(command rows: CPU in ns per call, blocks per call)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# coding=utf-8
+"""
+Benchmark of the continuous transfer engines against a simulated endpoint.
+
+The simulated device (daqflex.simulator) produces a sample counter at a
+fixed rate into a small FIFO. While a bulk transfer is queued, samples flow
+straight to the host; while no transfer is queued, they accumulate in the
+FIFO and are lost once it is full. The reading thread is stalled
+periodically to emulate Python processing and GIL contention. The
+benchmark reports the sustained throughput and the number of lost samples
+for PollingThread and for AsyncBulkReader at several queue depths.
+
+Usage: python benchmarks/bench_transfer.py [rate] [seconds]
+"""
+
+import array
+import os
+import sys
+import time
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import daqflex
+from daqflex.simulator import open_simulated
+from daqflex.utils import PollingThread, SampleRingBuffer
+from daqflex.transfer import AsyncBulkReader
+
+
+class StallingBuffer(SampleRingBuffer):
+    """Ring buffer whose writer is stalled every few packets."""
+
+    def __init__(self, capacity, stall, interval):
+        super(StallingBuffer, self).__init__(capacity)
+        self._stall = stall
+        self._interval = interval
+        self._writes = 0
+
+    def commit(self, count):
+        # every packet is published here, read in place or by write()
+        self._writes += 1
+        if self._writes % self._interval == 0:
+            time.sleep(self._stall)
+        super(StallingBuffer, self).commit(count)
+
+
+def count_gaps(data):
+    """Count discontinuities of the sample counter."""
+    diff = numpy.diff(numpy.frombuffer(data, dtype=numpy.uint16))
+    return int(numpy.count_nonzero(diff != 1))
+
+
+def run(rate, seconds, queue_depth=None, stall=0.02, interval=10):
+    packet_size = (rate // 1000 + 1) * 64
+    dev = open_simulated(daqflex.USB_1608G, fifo_size=4096,
+                         stop_on_overrun=False)
+    endpoint = dev._ep_in
+    data_buf = StallingBuffer(100 * packet_size // 2, stall, interval)
+    if queue_depth is None:
+        reader = PollingThread(endpoint, data_buf, packet_size, rate)
+    else:
+        reader = AsyncBulkReader(endpoint, data_buf, packet_size, rate,
+                                 queue_depth)
+    dev.send_message('AISCAN:SAMPLES=0')
+    dev.send_message('AISCAN:RATE={0}'.format(rate))
+    dev.send_message('AISCAN:START')
+    data = array.array('H')
+    t_start = time.time()
+    reader.start()
+    while time.time() < t_start + seconds:
+        reader.new_data.wait(0.1)
+        reader.new_data.clear()
+        data.extend(data_buf.read())
+    reader.shutdown.set()
+    reader.join()
+    dev.send_message('AISCAN:STOP')
+    elapsed = time.time() - t_start
+    data.extend(data_buf.read())
+    return len(data) / elapsed, dev.dev.lost, count_gaps(data)
+
+
+def main():
+    rate = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    print("rate = {0} S/s, {1} s per run".format(rate, seconds))
+    print("{0:<20} {1:>14} {2:>12} {3:>6}".format(
+        "engine", "samples/s", "lost", "gaps"))
+    for depth in [None, 1, 2, 4, 8]:
+        name = "PollingThread" if depth is None else \
+            "AsyncBulkReader({0})".format(depth)
+        throughput, lost, gaps = run(rate, seconds, depth)
+        print("{0:<20} {1:>14.0f} {2:>12} {3:>6}".format(
+            name, throughput, lost, gaps))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+# coding=utf-8
+"""
+asyncio front end for DAQFlex devices.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import array
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+
+class AsyncMCCDevice(object):
+    """
+    Awaitable wrapper around a MCCDevice.
+
+    All control transfers run on one dedicated I/O thread per device, so
+    commands are serialized without blocking the event loop. Continuous
+    transfer data is read by the device's polling thread; a notifier thread
+    wakes the event loop once per batch of new packets, and iter_bulk_data()
+    yields the accumulated blocks.
+    """
+
+    def __init__(self, device, executor=None):
+        """
+        :param device: a connected MCCDevice instance
+        :param executor: single-threaded executor for the device I/O
+        (default = None, create a new one)
+        """
+        self.device = device
+        self._io = executor or ThreadPoolExecutor(max_workers=1)
+        self._notifier = None
+        self._data_ready = None
+        self._finished = False
+
+    @classmethod
+    async def open(cls, device_class, *args, **kwargs):
+        """
+        Connect to a device on the I/O thread and return the wrapper.
+        :param device_class: the MCCDevice subclass to instantiate
+        All further arguments are passed to its constructor.
+        """
+        io = ThreadPoolExecutor(max_workers=1)
+        loop = asyncio.get_running_loop()
+        device = await loop.run_in_executor(
+            io, lambda: device_class(*args, **kwargs))
+        return cls(device, io)
+
+    async def _call(self, func, *args):
+        """Run a device method on the I/O thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io, func, *args)
+
+    async def send_message(self, message):
+        """Send a command message and return the device response."""
+        return await self._call(self.device.send_message, message)
+
+    async def send_messages(self, messages):
+        """Send several command messages and return the responses."""
+        return await self._call(self.device.send_messages, messages)
+
+    async def get_calib_data(self, channel):
+        """Return the calibration slope and offset of a channel."""
+        return await self._call(self.device.get_calib_data, channel)
+
+    async def read_scan_data(self, length, rate):
+        """Read the data generated by a finite AISCAN bulk transfer."""
+        return await self._call(self.device.read_scan_data, length, rate)
+
+    async def flush_input_data(self):
+        """Read and discard all remaining data from the bulk input."""
+        return await self._call(self.device.flush_input_data)
+
+    async def start_continuous_transfer(self, rate, buf_size,
+                                        packet_size=None, queue_depth=None,
+                                        **kwargs):
+        """
+        Start the continuous transfer and the event loop notifier.
+        See MCCDevice.start_continuous_transfer for the parameters.
+        """
+        await self._call(functools.partial(
+            self.device.start_continuous_transfer, rate, buf_size,
+            packet_size, queue_depth, **kwargs))
+        loop = asyncio.get_running_loop()
+        self._data_ready = asyncio.Event()
+        self._finished = False
+        self._notifier = Thread(target=self._notify,
+                                args=(loop, self.device._polling_thread))
+        self._notifier.daemon = True
+        self._notifier.start()
+
+    async def stop_continuous_transfer(self):
+        """Stop the continuous transfer and wait for the reader to finish."""
+        await self._call(self.device.stop_continuous_transfer)
+        if self._notifier is not None:
+            await self._call(self._notifier.join)
+            self._notifier = None
+
+    async def get_new_bulk_data(self, wait=False):
+        """
+        Return all continuous transfer data in the buffer, or an empty
+        array if no continuous transfer was started.
+        :param wait: if True, wait until new data is available
+        """
+        if self.device.data_buffer is None:
+            return array.array('H')
+        if wait and self._data_ready is not None and not self._finished:
+            await self._data_ready.wait()
+        if self._data_ready is not None:
+            self._data_ready.clear()
+        return self.device.data_buffer.read()
+
+    async def iter_bulk_data(self):
+        """
+        Asynchronously iterate over blocks of continuous transfer data
+        until the transfer is stopped::
+
+            async for block in adev.iter_bulk_data():
+                ...
+        """
+        while True:
+            finished = self._finished
+            data = await self.get_new_bulk_data(wait=True)
+            if data:
+                yield data
+            elif finished or self._data_ready is None:
+                return
+
+    async def close(self):
+        """Stop any transfer and shut down the I/O thread."""
+        await self.stop_continuous_transfer()
+        self._io.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _notify(self, loop, reader):
+        """Forward new data notifications of reader to the event loop."""
+        while reader.is_alive():
+            if reader.new_data.wait(0.1):
+                reader.new_data.clear()
+                loop.call_soon_threadsafe(self._data_ready.set)
+        loop.call_soon_threadsafe(self._set_finished)
+
+    def _set_finished(self):
+        self._finished = True
+        self._data_ready.set()
@@ -0,0 +1,125 @@
+# coding=utf-8
+"""
+Persistent on-disk cache of device descriptors and calibration data.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import json
+import os
+import re
+import tempfile
+import time
+
+# format version of the cache files
+CACHE_VERSION = 1
+
+
+class DeviceCache(object):
+    """
+    Persistent cache of device information for fast reconnects.
+
+    Each device has its own JSON file, keyed by product id and serial
+    number, so processes using different devices never write the same
+    file. Files are replaced atomically. The device stores what it
+    learns during a connection (interface and endpoint numbers, static
+    query responses, calibration constants and the accepted FPGA upload
+    chunk size) and restores it on the next connection after validating
+    the firmware version. Entries older than ttl seconds are discarded,
+    so the information is refreshed from the device periodically.
+    """
+
+    def __init__(self, directory=None, ttl=24 * 3600.0):
+        """
+        :param directory: the cache directory (default = None, use
+        $XDG_CACHE_HOME/daqflex or ~/.cache/daqflex)
+        :param ttl: the maximum age of an entry in seconds
+        (default = one day)
+        """
+        if directory is None:
+            directory = os.path.join(
+                os.environ.get('XDG_CACHE_HOME') or
+                os.path.join(os.path.expanduser('~'), '.cache'), 'daqflex')
+        self.directory = directory
+        self.ttl = ttl
+
+    def path(self, product_id, serial_number):
+        """Return the file name of the entry of a device."""
+        serial = re.sub(r'[^0-9A-Za-z]', '_', str(serial_number))
+        return os.path.join(self.directory, '{0:04x}_{1}.json'.format(
+            product_id, serial))
+
+    def load(self, product_id, serial_number):
+        """
+        Return the cached entry of a device as a dict, or None if there
+        is no valid entry (missing, unreadable, outdated or expired).
+        :param product_id: the USB product id
+        :param serial_number: the serial number of the device
+        """
+        try:
+            with open(self.path(product_id, serial_number)) as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or \
+                entry.get('version') != CACHE_VERSION:
+            return None
+        age = time.time() - entry.get('created', 0)
+        if not 0 <= age <= self.ttl:
+            return None
+        return entry
+
+    def store(self, product_id, serial_number, entry):
+        """
+        Write the entry of a device, replacing the previous one.
+        :param product_id: the USB product id
+        :param serial_number: the serial number of the device
+        :param entry: JSON serializable dict
+        """
+        entry = dict(entry, version=CACHE_VERSION)
+        entry.setdefault('created', time.time())
+        # worker processes may create the directory at the same time
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(product_id, serial_number)
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w') as cache_file:
+                json.dump(entry, cache_file, indent=1, sort_keys=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def invalidate(self, product_id, serial_number):
+        """
+        Remove the entry of a device.
+        :param product_id: the USB product id
+        :param serial_number: the serial number of the device
+        """
+        try:
+            os.remove(self.path(product_id, serial_number))
+        except OSError:
+            pass
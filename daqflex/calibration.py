@@ -0,0 +1,177 @@
+# coding=utf-8
+"""
+Vectorized scaling and calibration of interleaved multi-channel scan data.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import numpy
+
+# full scale counts of the 12 and 16 bit devices, which are converted with
+# a lookup table of all uint16 values
+LUT_MAX_COUNTS = (0x0FFF, 0xFFFF)
+
+
+def scale_and_calibrate(data, max_counts, min_voltage, max_voltage, calib):
+    """
+    Apply scaling and calibration to calculate voltages from raw data.
+    :param data: the raw data (number or numpy array)
+    :param max_counts: the full scale count value of the device
+    :param min_voltage: selected minimum voltage of the AI channel
+    :param max_voltage: selected maximum voltage of the AI channel
+    :param calib: calibration slope and offset as a tuple
+    """
+    slope, offset = calib
+    full_scale = max_voltage - min_voltage
+    cal_data = data * float(slope) + offset
+    return (cal_data / max_counts) * full_scale + min_voltage
+
+
+class ScanCalibration(object):
+    """
+    Converts interleaved raw AISCAN data of several channels to voltages.
+
+    Each channel of the scan (in LOWCHAN..HIGHCHAN order) has its own
+    voltage range and calibration. For 12 and 16 bit devices a lookup
+    table of all 65536 uint16 values is computed once per channel, so
+    conversion is a single table lookup per sample; values above
+    max_counts convert as in scale_and_calibrate. Other devices use a
+    precomputed gain and offset per channel.
+    Table lookups go through contiguous scratch arrays that are kept
+    between calls, so an instance must not convert from several threads
+    at once.
+    """
+
+    def __init__(self, max_counts, ranges, calibs, dtype=numpy.float64):
+        """
+        :param max_counts: the full scale count value of the device
+        :param ranges: (min_voltage, max_voltage) for each channel
+        :param calibs: (slope, offset) for each channel
+        (see MCCDevice.get_calib_data)
+        :param dtype: the output data type, float32 or float64
+        (default = float64)
+        """
+        if len(ranges) != len(calibs):
+            raise ValueError('ranges and calibs must have equal length')
+        if not ranges:
+            raise ValueError('at least one channel is required')
+        self.max_counts = max_counts
+        self.ranges = [tuple(rng) for rng in ranges]
+        self.calibs = [tuple(cal) for cal in calibs]
+        self.dtype = numpy.dtype(dtype)
+        self.channels = len(ranges)
+        self._tables = None
+        self._gains = None
+        self._offsets = None
+        # contiguous index and result arrays for numpy.take, which
+        # buffers strided outputs and converts uint16 indices otherwise
+        self._index = numpy.empty(0, dtype=numpy.intp)
+        self._result = numpy.empty(0, dtype=self.dtype)
+        if max_counts in LUT_MAX_COUNTS:
+            counts = numpy.arange(0x10000, dtype=numpy.float64)
+            self._tables = [
+                scale_and_calibrate(counts, max_counts, rng[0], rng[1],
+                                    cal).astype(self.dtype)
+                for rng, cal in zip(self.ranges, self.calibs)]
+        else:
+            self._gains = []
+            self._offsets = []
+            for (min_voltage, max_voltage), (slope, offset) in \
+                    zip(self.ranges, self.calibs):
+                full_scale = max_voltage - min_voltage
+                self._gains.append(float(slope) * full_scale / max_counts)
+                self._offsets.append(
+                    offset * full_scale / max_counts + min_voltage)
+
+    def convert(self, raw, out=None, phase=0):
+        """
+        Convert a block of interleaved raw samples to voltages.
+        :param raw: the raw uint16 samples (array or numpy array)
+        :param out: optional output array of len(raw) and the configured
+        dtype; converting into it allocates no memory
+        (default = None, return a new array)
+        :param phase: the channel index of the first sample in raw
+        (default = 0)
+        """
+        raw = numpy.frombuffer(raw, dtype=numpy.uint16) \
+            if not isinstance(raw, numpy.ndarray) else raw
+        if out is None:
+            out = numpy.empty(len(raw), dtype=self.dtype)
+        elif len(out) != len(raw):
+            raise ValueError('out must have the same length as raw')
+        step = self.channels
+        for chan in range(step):
+            start = (chan - phase) % step
+            src = raw[start::step]
+            dst = out[start::step]
+            if self._tables is not None:
+                self._lookup(chan, src, dst)
+            else:
+                numpy.multiply(src, self._gains[chan], out=dst)
+                numpy.add(dst, self._offsets[chan], out=dst)
+        return out
+
+    def convert_scans(self, scans, out=None):
+        """
+        Convert a (scans, channels) block of raw data, e.g. from a
+        ScanDemultiplexer, to voltages of the same shape. Column i of the
+        result holds the voltages of channel i.
+        :param scans: the raw uint16 samples, one row per scan
+        :param out: optional output array of the same shape and the
+        configured dtype (default = None, return a new array)
+        """
+        if scans.shape[1] != self.channels:
+            raise ValueError('scans must have one column per channel')
+        if out is None:
+            out = numpy.empty(scans.shape, dtype=self.dtype)
+        for chan in range(self.channels):
+            if self._tables is not None:
+                self._lookup(chan, scans[:, chan], out[:, chan])
+            else:
+                numpy.multiply(scans[:, chan], self._gains[chan],
+                               out=out[:, chan])
+                numpy.add(out[:, chan], self._offsets[chan],
+                          out=out[:, chan])
+        return out
+
+    def _lookup(self, chan, src, dst):
+        """
+        Look up the voltages of the raw samples src of a channel in its
+        table and store them in dst, without allocating memory once the
+        scratch arrays are large enough. The table covers all uint16
+        values, so mode='clip' (which avoids buffering out) never clips.
+        """
+        count = len(src)
+        if len(self._index) < count:
+            self._index = numpy.empty(count, dtype=numpy.intp)
+            self._result = numpy.empty(count, dtype=self.dtype)
+        index = self._index[:count]
+        index[...] = src
+        if dst.flags.c_contiguous:
+            numpy.take(self._tables[chan], index, out=dst, mode='clip')
+        else:
+            result = self._result[:count]
+            numpy.take(self._tables[chan], index, out=result, mode='clip')
+            dst[...] = result
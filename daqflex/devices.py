@@ -33,10 +33,68 @@ import errno
 import array
 import codecs
 import collections
-import pkg_resources
+import contextlib
+import os
+import re
 import time
-import usb
-from .utils import PollingThread
+from threading import Lock
+from .utils import PollingThread, SampleRingBuffer, DROP_OLDEST, \
+    read_into, usb
+from .transfer import AsyncBulkReader
+from .metrics import AcquisitionMetrics, MetricsExporter
+from .output import OutputStream
+from .timestamps import ClockModel
+
+# usb.TYPE_VENDOR + usb.ENDPOINT_OUT / usb.ENDPOINT_IN
+_REQUEST_OUT = 0x40
+_REQUEST_IN = 0xC0
+
+# maximum number of bytes requested by a single read of read_scan_data
+READ_CHUNK_SIZE = 1 << 16
+# allowance in seconds for the scan start and USB latency of a read
+READ_START_LATENCY = 0.1
+
+# chunk sizes for the FPGA image upload, largest first (see
+# MCCDevice.max_fpga_chunk_size)
+FPGA_CHUNK_SIZES = (4096, 1024, 256, 64)
+# polling interval bounds and timeout for the FPGA configuration in seconds
+FPGA_POLL_MIN_DELAY = 0.005
+FPGA_POLL_MAX_DELAY = 0.05
+FPGA_CONFIG_TIMEOUT = 2.0
+
+FirmwareUploadStats = collections.namedtuple(
+    'FirmwareUploadStats', 'size chunk_size transfer_time config_time')
+
+# firmware images and accepted chunk sizes, shared by all devices
+_firmware_images = {}
+_fpga_chunk_size = {}
+_firmware_lock = Lock()
+
+
+def _load_firmware(name):
+    """Return the contents of a firmware file, reading it only once."""
+    with _firmware_lock:
+        image = _firmware_images.get(name)
+        if image is None:
+            path = os.path.join(os.path.dirname(__file__), name)
+            with open(path, 'rb') as rbf:
+                image = rbf.read()
+            _firmware_images[name] = image
+        return image
+
+
+# commands that change the input range of one or all analog input channels
+_AI_RANGE_RE = re.compile(r'^AI(?:\{(\d+)\})?:(RANGE|CHMODE)=(.*)$')
+# commands after which all calibration data has to be queried again
+_RECALIBRATION_RE = re.compile(r'^(AICAL:START|DEV:RESET/\w+)$')
+
+
+def default_packet_size(rate):
+    """
+    Return the default continuous transfer size in bytes for a sample rate
+    in Hz: 64 bytes per started 1000 S/s, about 32 ms of data.
+    """
+    return (int(rate) // 1000 + 1) * 64
 
 
 class MCCDevice(object):
@@ -47,17 +105,37 @@ class MCCDevice(object):
     id_product = None
     max_counts = None
     fpga_image = None
-
-    def __init__(self, serial_number=None):
+    # largest chunk size tried for the FPGA image upload. Command 0x51 is
+    # documented for 64 bytes, and some firmware drops the excess bytes
+    # of larger chunks, which is only noticed when the FPGA does not
+    # configure; set a larger size from FPGA_CHUNK_SIZES for firmware
+    # known to accept it.
+    max_fpga_chunk_size = 64
+    # queries whose response never changes while the device is connected
+    static_queries = frozenset(['?DEV:MFGSER', '?DEV:FWV', '?DEV:FPGAV',
+                                '?AI', '?AO', '?DIO', '?CTR'])
+
+    def __init__(self, serial_number=None, cache_responses=False,
+                 usb_device=None, device_cache=None):
         """
         Connect to a device with a given product id and serial number.
         :param serial_number: serial number of the device to connect to
         (default = None, use the first device regardless of serial number)
+        :param cache_responses: if True, answer repeated static_queries
+        from a cache instead of the device (default = False)
+        :param usb_device: an already opened PyUSB device, or a
+        simulator.SimulatedDevice (default = None, search the USB bus)
+        :param device_cache: a cache.DeviceCache restoring the interface,
+        static query responses and calibration data of a previous
+        connection, which saves most control transfers on reconnect;
+        implies cache_responses (default = None)
         """
         if self.id_product is None:
             raise ValueError('id_product not defined')
         # find our device
-        if serial_number is None:
+        if usb_device is not None:
+            self.dev = usb_device
+        elif serial_number is None:
             self.dev = usb.core.find(idVendor=self.id_vendor,
                                      idProduct=self.id_product)
         else:
@@ -68,33 +146,53 @@ class MCCDevice(object):
         if self.dev is None:
             raise ValueError('Device not found')
         self.dev.set_configuration()
-        self._intf = self.__get_interface()
-        self._ep_in = self.__get_bulk_endpoint(usb.util.ENDPOINT_IN)
-        self._ep_out = self.__get_bulk_endpoint(usb.util.ENDPOINT_OUT)
-        if self._ep_in:
-            self._bulk_packet_size = self._ep_in.wMaxPacketSize
         self._polling_thread = None
+        self._recorder = None
+        self._metrics_exporter = None
+        self._pipeline = None
+        self._output_stream = None
+        self._clock = None
         self.data_buffer = None
+        # calibration data per (channel, range) and known channel ranges
+        self._calib_cache = {}
+        self._ranges = {}
+        self._response_cache = {} if cache_responses or device_cache \
+            else None
+        # AISCAN settings sent through send_message, e.g. for restarts
+        self.scan_config = {}
+        # keeps the request and response of a message together
+        self._message_lock = Lock()
+        self.fpga_upload_stats = None
+        self._device_cache = device_cache
+        # entry written through to device_cache once connected; batches
+        # of queries write it once at their end
+        self._cache_entry = None
+        self._cache_batch_depth = 0
+        self._cache_dirty = False
+        entry = None
+        if device_cache is not None:
+            entry = self.__load_cache_entry()
+        self._intf = self.__get_interface(entry)
+        self._ep_in = self.__get_bulk_endpoint(usb.util.ENDPOINT_IN, entry)
+        self._ep_out = self.__get_bulk_endpoint(usb.util.ENDPOINT_OUT,
+                                                entry)
+        if self._ep_in:
+            self._bulk_packet_size = self._ep_in.wMaxPacketSize
         # does this model require FPGA firmware loading?
         if self.fpga_image:
             # Check FPGA configuration status
             ret = self.send_message('?DEV:FPGACFG')
             if ret == 'DEV:FPGACFG=CONFIGMODE':
                 # FPGA has not yet been loaded
-                # Send FW upload unlock code 0xAD
-                self.send_message('DEV:FPGACFG=0xAD')
-                # retrieve FPGA image from Python package
-                rbf = pkg_resources.resource_string(__name__, self.fpga_image)
-                # transmit image 64 bytes at a time using command 0x51
-                for i in range(0, len(rbf), 64):
-                    msg = rbf[i:i + 64]
-                    self.dev.ctrl_transfer(usb.TYPE_VENDOR + usb.ENDPOINT_OUT,
-                                           0x51, 0, 0, msg)
-                # minimum pause seems to be necessary after sending the firmware
-                time.sleep(0.25)
-            ret = self.send_message('?DEV:FPGACFG')
+                self.fpga_upload_stats = self.__upload_fpga_image()
+                ret = self.send_message('?DEV:FPGACFG')
             if ret != 'DEV:FPGACFG=CONFIGURED':
                 raise IOError("Could not configure FPGA")
+        if entry is not None:
+            # the firmware version validates the entry on reconnect
+            self.send_message('?DEV:FWV')
+            self._cache_entry = entry
+            self.__save_cache_entry()
 
     @classmethod
     def find_serial_numbers(cls):
@@ -108,41 +206,109 @@ class MCCDevice(object):
         and return the device response.
         :param message: the command string to send
         """
+        return self.send_messages([message])[0]
+
+    def send_messages(self, messages):
+        """
+        Send several command messages back to back and return the list
+        of device responses.
+        :param messages: the command strings to send
+        """
+        messages = [message.upper() for message in messages]
+        # as encode_message, without converting to upper case again
+        payloads = [(message + '\0').encode('ascii') for message in messages]
+        cache = self._response_cache
+        responses = []
+        with self.__cache_batch():
+            for message, payload in zip(messages, payloads):
+                if cache is not None and message in cache:
+                    responses.append(cache[message])
+                    continue
+                response = self.send_encoded(payload)
+                ret = codecs.decode(response, 'ascii').rstrip(chr(0))
+                if message.startswith('?'):
+                    if cache is not None and message in self.static_queries:
+                        cache[message] = ret
+                        self.__cache_changed()
+                else:
+                    self.__update_calib_cache(message)
+                    if message.startswith('AISCAN:') and '=' in message:
+                        name, value = message.split('=', 1)
+                        self.scan_config[name] = value
+                responses.append(ret)
+        return responses
+
+    @staticmethod
+    def encode_message(message):
+        """
+        Return the control transfer payload for a command message, e.g. to
+        prepare messages that are sent later with send_encoded.
+        :param message: the command string
+        """
         # Some devices (e.g. USB-1608G series) expect a null-terminated string
-        message += '\0'
+        return (message.upper() + '\0').encode('ascii')
 
-        try:
-            assert self.dev.ctrl_transfer(
-                usb.TYPE_VENDOR + usb.ENDPOINT_OUT, 0x80, 0, 0,
-                message.upper().encode('ascii')) == len(message)
-        except AssertionError:
-            raise IOError("Could not send message")
-        except usb.core.USBError:
-            raise IOError("Send failed, possibly wrong command?")
-        ret = self.dev.ctrl_transfer(usb.TYPE_VENDOR + usb.ENDPOINT_IN,
-                                     0x80, 0, 0, 64)
-        return codecs.decode(ret, 'ascii').rstrip(chr(0))
+    def send_encoded(self, payload):
+        """
+        Send a payload from encode_message and return the raw response.
+        This bypasses the response cache and the tracking of calibration
+        and scan settings, so it is only meant for time-critical commands
+        like DIO or AO values.
+        :param payload: the encoded command message
+        """
+        ctrl_transfer = self.dev.ctrl_transfer
+        with self._message_lock:
+            try:
+                assert ctrl_transfer(_REQUEST_OUT, 0x80, 0, 0,
+                                     payload) == len(payload)
+            except AssertionError:
+                raise IOError("Could not send message")
+            except usb.core.USBError:
+                raise IOError("Send failed, possibly wrong command?")
+            return ctrl_transfer(_REQUEST_IN, 0x80, 0, 0, 64)
 
     def read_scan_data(self, length, rate):
         """
         Read the data generated by a AISCAN bulk transfer.
+        The data is read in large chunks directly into a preallocated
+        array. Each read may take twice the time the scan needs to fill
+        it, plus READ_START_LATENCY. A timed out read may have received
+        data that is lost, so it raises an IOError while the scan is still
+        running; once the scan has ended, the data read before is returned
+        (fewer than length values).
         :param length: the number of values to read
         :param rate: the sample rate of the AISCAN command in Hz
         """
-        timeout = int(self._bulk_packet_size * 1e3 / 2 / rate) + 10
-        data = array.array('H')
-        while True:
-            packet = None
+        packet_size = self._bulk_packet_size
+        # reads must be multiples of the packet size to avoid overflows
+        size = -(-length * 2 // packet_size) * packet_size
+        data = array.array('H', [0]) * (size // 2)
+        view = memoryview(data).cast('B')
+        chunk_size = max(READ_CHUNK_SIZE // packet_size, 1) * packet_size
+        pos = 0
+        while pos < length * 2:
+            chunk = min(size - pos, chunk_size)
+            timeout = int(1e3 * (chunk / float(rate) + READ_START_LATENCY))
             try:
-                packet = self._ep_in.read(self._bulk_packet_size, timeout)
+                count = read_into(self._ep_in, view[pos:pos + chunk],
+                                  timeout)
             except usb.core.USBError as err:
                 if err.errno != errno.ETIMEDOUT:
                     raise err
-            if (packet is None) or (len(packet) == 0):
-                break
-            data.fromstring(packet)
-            if len(data) >= length:
+                count = None
+            if count:
+                pos += count
+                continue
+            status = self.send_message("?AISCAN:STATUS").split('=')[1]
+            if status == 'OVERRUN':
+                raise IOError("AISCAN overrun")
+            if status != 'RUNNING':
                 break
+            if count is None:
+                raise IOError("AISCAN read timed out after {0} of {1} "
+                              "values".format(pos // 2, length))
+        view.release()
+        del data[min(pos // 2, length):]
         return data
 
     def flush_input_data(self):
@@ -155,57 +321,317 @@ class MCCDevice(object):
             if len(packet) == 0:
                 break
 
-    def start_continuous_transfer(self, rate, buf_size, packet_size=None):
+    def start_continuous_transfer(self, rate, buf_size, packet_size=None,
+                                  queue_depth=None, recorder=None,
+                                  metrics_callback=None, metrics_interval=1.0,
+                                  overflow=DROP_OLDEST, pipeline=None,
+                                  data_buffer=None, channels=1, tuner=None,
+                                  supervisor=None):
         """
         Start an asynchronous data transfer to read AISCAN values.
         :param rate: the sample rate of the AISCAN command in Hz
         :param buf_size: the maximum number of data packets in the buffer
         :param packet_size: the size of a data packet in bytes
-        (default = None, automatic determination based on rate)
+        (default = None, automatic determination based on rate and
+        channels)
+        :param queue_depth: number of bulk transfers to keep in flight
+        using the libusb asynchronous API (default = None, issue one
+        blocking read at a time)
+        :param recorder: a Recorder that writes all data to disk
+        (default = None, no recording)
+        :param metrics_callback: function called periodically with a
+        MetricsSnapshot of the transfer (default = None, no export)
+        :param metrics_interval: export interval of metrics_callback in
+        seconds (default = 1.0)
+        :param overflow: what to do if the buffer is full, one of
+        'drop-oldest', 'drop-newest', 'block' (stall the USB reads) or
+        'raise' (stop the transfer, get_new_bulk_data raises
+        BufferOverflowError after the buffered data) (default = 'drop-oldest')
+        :param pipeline: a Pipeline that processes all data as it arrives
+        (default = None, poll with get_new_bulk_data)
+        :param data_buffer: a buffer with the SampleRingBuffer interface
+        to write to instead of a new one, e.g. a SharedSampleRing; buf_size
+        and overflow are ignored (default = None)
+        :param channels: the number of channels per scan, used for the
+        packet size and to convert sample indices to timestamps
+        (default = 1)
+        :param tuner: a TransferTuner that adapts the packet size and the
+        read timeout at runtime; buf_size then counts packets of its
+        initial size (default = None, fixed packet size)
+        :param supervisor: a StreamSupervisor that restarts the scan after
+        USB errors and device FIFO overruns (default = None, the transfer
+        ends at the first error)
         """
-        if packet_size is None:
-            packet_size = (rate // 1000 + 1) * 64
-        self.data_buffer = collections.deque(maxlen=buf_size)
-        self._polling_thread = PollingThread(self._ep_in, self.data_buffer,
-                                             packet_size, rate)
+        if queue_depth is not None and (tuner or supervisor):
+            raise ValueError('tuner and supervisor require blocking reads, '
+                             'use queue_depth=None')
+        if tuner is not None:
+            packet_size = tuner.initial_packet_size(rate, channels,
+                                                    self._bulk_packet_size)
+        elif packet_size is None:
+            packet_size = default_packet_size(rate * channels)
+        if data_buffer is None:
+            data_buffer = SampleRingBuffer(buf_size * (packet_size // 2),
+                                           overflow)
+        self.data_buffer = data_buffer
+        self._clock = ClockModel(rate, channels)
+        metrics = AcquisitionMetrics(data_buffer, rate, channels)
+        if tuner is not None:
+            tuner.start(rate, channels, data_buffer.capacity,
+                        self._bulk_packet_size)
+        if queue_depth is None:
+            self._polling_thread = PollingThread(
+                self._ep_in, self.data_buffer, packet_size, rate,
+                metrics=metrics, clock=self._clock, tuner=tuner)
+            if supervisor is not None:
+                supervisor.attach(self, self._polling_thread)
+        else:
+            self._polling_thread = AsyncBulkReader(
+                self._ep_in, self.data_buffer, packet_size, rate,
+                queue_depth, metrics=metrics, clock=self._clock)
+        self._recorder = recorder
+        if recorder is not None:
+            recorder.attach(self.data_buffer, self.describe_scan(rate))
+            recorder.start()
+        if metrics_callback is not None:
+            self._metrics_exporter = MetricsExporter(
+                self._polling_thread.metrics, metrics_callback,
+                metrics_interval)
+            self._metrics_exporter.start()
+        self._pipeline = pipeline
+        if pipeline is not None:
+            pipeline.attach(self._polling_thread)
         self._polling_thread.start()
 
     def stop_continuous_transfer(self):
         """
         Stop the asynchronous data transfer and wait for the data collection
-        to finish.
+        to finish. Raises the error that ended an AsyncBulkReader transfer.
         """
+        error = None
         if self._polling_thread is not None:
             self._polling_thread.shutdown.set()
+            # release a reader blocked by the 'block' overflow policy
+            self.data_buffer.close()
             self._polling_thread.join()
+            error = getattr(self._polling_thread, 'error', None)
             self._polling_thread = None
+        if self._recorder is not None:
+            self._recorder.stop()
+            self._recorder = None
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.stop()
+            self._metrics_exporter = None
+        if self._pipeline is not None:
+            pipeline, self._pipeline = self._pipeline, None
+            pipeline.stop()
+        if error is not None:
+            raise error
+
+    def get_transfer_metrics(self):
+        """
+        Return a MetricsSnapshot of the running continuous transfer
+        (packets, bytes, read latency histogram, timeouts, buffer level
+        and consumer lag), or None if no transfer is running.
+        """
+        if self._polling_thread is None:
+            return None
+        return self._polling_thread.metrics.snapshot()
+
+    def get_clock_model(self):
+        """
+        Return the ClockModel of the last continuous transfer, mapping
+        stream sample indices to host time.monotonic() timestamps, e.g.
+        times = dev.get_clock_model().block_times(dev.get_new_bulk_block())
+        Returns None if no transfer was started.
+        """
+        return self._clock
 
     def get_new_bulk_data(self, wait=False):
         """
-        Return all continuous transfer data in the buffer.
+        Return all continuous transfer data in the buffer, or an empty
+        array if no continuous transfer was started.
         :param wait: if True, block until new data is available
         """
-        if wait and self._polling_thread is not None:
-            self._polling_thread.new_data.wait()
-        data = array.array("H")
-        while self.data_buffer:
-            data.extend(self.data_buffer.popleft())
+        if self.data_buffer is None:
+            return array.array('H')
         if self._polling_thread is not None:
+            if wait:
+                self._polling_thread.new_data.wait()
+            # clear before reading, so that data arriving meanwhile sets
+            # the event again and the next wait does not miss it
             self._polling_thread.new_data.clear()
-        return data
+        return self.data_buffer.read()
+
+    def get_new_bulk_block(self, wait=False):
+        """
+        Return the continuous transfer data in the buffer up to the next
+        gap as a DataBlock (sequence, data), where sequence is the sample
+        number of data[0] since the start of the transfer. Lost samples
+        show up as a jump of the sequence number; see get_transfer_gaps().
+        :param wait: if True, block until new data is available
+        """
+        if self._polling_thread is not None:
+            if wait:
+                self._polling_thread.new_data.wait()
+            self._polling_thread.new_data.clear()
+        block = self.data_buffer.read_block()
+        if self._polling_thread is not None and self.data_buffer:
+            # more data after a gap
+            self._polling_thread.new_data.set()
+        return block
+
+    def get_transfer_gaps(self):
+        """
+        Return the ranges of lost samples of the continuous transfer as a
+        list of (start, end) sample numbers, end exclusive.
+        """
+        return list(self.data_buffer.gaps)
+
+    def start_output_scan(self, rate, low_channel=0, high_channel=0,
+                          samples=0, waveform=None, data=None, buffers=2,
+                          packet_size=None):
+        """
+        Configure and start a hardware-paced analog output scan (AOSCAN)
+        fed through the bulk OUT endpoint, and return its OutputStream.
+        Output data is given either as a waveform that is repeated (and can
+        be replaced with OutputStream.set_waveform) or as blocks passed to
+        OutputStream.write, starting with data. The scan is started as
+        soon as the first data has been written to the device.
+        :param rate: the output rate in scans per second
+        :param low_channel: the first output channel (default = 0)
+        :param high_channel: the last output channel (default = 0)
+        :param samples: the number of scans, 0 for continuous output
+        (default = 0)
+        :param waveform: uint16 samples of one period, interleaved by
+        channel (default = None)
+        :param data: the first block of uint16 samples (default = None)
+        :param buffers: the number of blocks queued by OutputStream.write
+        (default = 2, double buffering)
+        :param packet_size: the size of a bulk write in bytes
+        (default = None, automatic determination based on rate)
+        """
+        if self._ep_out is None:
+            raise IOError('Device has no bulk OUT endpoint')
+        if self._output_stream is not None:
+            raise IOError('Output scan already running')
+        self.send_messages(["AOSCAN:LOWCHAN={0}".format(low_channel),
+                            "AOSCAN:HIGHCHAN={0}".format(high_channel),
+                            "AOSCAN:SAMPLES={0}".format(samples),
+                            "AOSCAN:RATE={0}".format(rate)])
+        stream = OutputStream(self._ep_out, rate,
+                              high_channel - low_channel + 1, packet_size,
+                              buffers)
+        if waveform is not None:
+            stream.set_waveform(waveform)
+        if data is not None:
+            stream.write(data)
+        stream.start()
+        # the device FIFO must hold data before the scan starts
+        if not stream.primed.wait(1.0) or stream.error is not None:
+            stream.stop()
+            raise stream.error or IOError('No output data')
+        self.send_message("AOSCAN:START")
+        stream.started()
+        self._output_stream = stream
+        return stream
+
+    def stop_output_scan(self, wait=False):
+        """
+        Stop the analog output scan.
+        :param wait: if True, output all queued data before stopping
+        (default = False)
+        """
+        stream, self._output_stream = self._output_stream, None
+        if stream is None:
+            return
+        if wait:
+            stream.close()
+            stream.join()
+            # let the device play the contents of its FIFO
+            while self.get_output_status() == 'RUNNING':
+                time.sleep(0.01)
+        stream.stop()
+        self.send_message("AOSCAN:STOP")
+        if stream.error is not None:
+            raise stream.error
+
+    def get_output_status(self):
+        """Return the output scan status, e.g. RUNNING, IDLE or UNDERRUN."""
+        return self.send_message("?AOSCAN:STATUS").split('=')[1]
+
+    def describe_scan(self, rate):
+        """
+        Return a dict describing the configured AISCAN (device, channels,
+        ranges and calibration), e.g. for recording metadata.
+        :param rate: the sample rate of the AISCAN command in Hz
+        """
+        low, high = [int(resp.split('=')[1]) for resp in self.send_messages(
+            ["?AISCAN:LOWCHAN", "?AISCAN:HIGHCHAN"])]
+        channels = list(range(low, high + 1))
+        return {
+            'model': type(self).__name__,
+            'serial_number': self.dev.serial_number,
+            'max_counts': self.max_counts,
+            'rate': rate,
+            'channels': channels,
+            'ranges': [self.get_range(chan) for chan in channels],
+            'calibration': [self.get_calib_data(chan) for chan in channels],
+        }
 
     def get_calib_data(self, channel):
         """
         Query the calibration parameters slope and offset for a given channel.
         The returned values are only valid for the currently selected
-        voltage range.
+        voltage range. Results are cached per channel and range; the cache
+        is invalidated by range changes and recalibration commands sent
+        through send_message.
         :param channel: the analog input channel to calibrate
         """
-        slope = float(self.send_message(
-            "?AI{{{0}}}:SLOPE".format(channel)).split('=')[1])
-        offset = float(self.send_message(
-            "?AI{{{0}}}:OFFSET".format(channel)).split('=')[1])
-        return slope, offset
+        key = (int(channel), self.get_range(channel))
+        calib = self._calib_cache.get(key)
+        if calib is None:
+            slope = float(self.send_message(
+                "?AI{{{0}}}:SLOPE".format(channel)).split('=')[1])
+            offset = float(self.send_message(
+                "?AI{{{0}}}:OFFSET".format(channel)).split('=')[1])
+            calib = self._calib_cache[key] = (slope, offset)
+            self.__cache_changed()
+        return calib
+
+    def get_range(self, channel):
+        """
+        Return the configured range of an analog input channel
+        (e.g. 'BIP10V'). The range is only queried from the device if it
+        was not set through send_message before.
+        :param channel: the analog input channel
+        """
+        channel = int(channel)
+        rng = self._ranges.get(channel)
+        if rng is None:
+            rng = self.send_message(
+                "?AI{{{0}}}:RANGE".format(channel)).split('=')[1]
+            self._ranges[channel] = rng
+        return rng
+
+    def prefetch_calib_data(self, channels=None):
+        """
+        Fill the calibration cache for several channels at once.
+        :param channels: the analog input channels
+        (default = None, all channels of the device)
+        :returns: dict of channel -> (slope, offset)
+        """
+        with self.__cache_batch():
+            if channels is None:
+                channels = range(int(self.send_message("?AI").split('=')[1]))
+            return dict((channel, self.get_calib_data(channel))
+                        for channel in channels)
+
+    def clear_calib_cache(self):
+        """Forget all cached calibration data and channel ranges."""
+        self._calib_cache.clear()
+        self._ranges.clear()
+        self.__cache_changed()
 
     @classmethod
     def scale_and_calibrate_data(cls, data, min_voltage, max_voltage, calib):
@@ -217,23 +643,148 @@ class MCCDevice(object):
         :param calib: calibration slope and offset as a tuple
         (see get_calib_data)
         """
-        slope, offset = calib
-        full_scale = max_voltage - min_voltage
-        cal_data = data * float(slope) + offset
-        return (cal_data / cls.max_counts) * full_scale + min_voltage
+        from .calibration import scale_and_calibrate
+        return scale_and_calibrate(data, cls.max_counts, min_voltage,
+                                   max_voltage, calib)
 
-    def __get_interface(self):
-        """Get the USB interface descriptor."""
+    def get_scan_calibration(self, channels, ranges, dtype='float64'):
+        """
+        Query the calibration of several channels and return a
+        ScanCalibration to convert interleaved scan data to voltages.
+        The calibration is only valid for the currently selected ranges.
+        :param channels: the analog input channels in scan order
+        :param ranges: (min_voltage, max_voltage) for each channel
+        :param dtype: the output data type, float32 or float64
+        (default = float64)
+        """
+        from .calibration import ScanCalibration
+        with self.__cache_batch():
+            calibs = [self.get_calib_data(channel) for channel in channels]
+        return ScanCalibration(self.max_counts, ranges, calibs, dtype)
+
+    def __update_calib_cache(self, message):
+        """
+        Invalidate cached calibration data affected by a sent command.
+        :param message: the upper case command string
+        """
+        match = _AI_RANGE_RE.match(message)
+        if match:
+            channel, prop, value = match.groups()
+            if channel is None:
+                self._ranges.clear()
+            elif prop == 'RANGE':
+                self._ranges[int(channel)] = value
+            else:
+                self._ranges.pop(int(channel), None)
+            if prop == 'CHMODE':
+                # the channel count reported by ?AI depends on the mode
+                if self._response_cache is not None:
+                    self._response_cache.pop('?AI', None)
+                self._calib_cache.clear()
+                self.__cache_changed()
+        elif _RECALIBRATION_RE.match(message):
+            if self._response_cache is not None:
+                self._response_cache.clear()
+            self.clear_calib_cache()
+
+    def __upload_fpga_image(self):
+        """
+        Transmit the FPGA image and wait until the FPGA is configured.
+        Chunks are up to max_fpga_chunk_size bytes. If the FPGA does not
+        configure after an upload in chunks larger than the documented 64
+        bytes, the upload is repeated with 64 byte chunks. Returns the
+        FirmwareUploadStats of the upload.
+        """
+        t_start = time.time()
+        rbf = _load_firmware(self.fpga_image)
+        limit = min(self.max_fpga_chunk_size,
+                    _fpga_chunk_size.get(type(self), self.max_fpga_chunk_size))
+        sizes = [size for size in FPGA_CHUNK_SIZES if size <= limit] or \
+            [FPGA_CHUNK_SIZES[-1]]
+        while True:
+            chunk_size = self.__send_fpga_image(rbf, sizes)
+            t_sent = time.time()
+            configured = self.__wait_fpga_configured()
+            if configured or chunk_size == FPGA_CHUNK_SIZES[-1]:
+                break
+            # the device may have dropped the excess bytes of each chunk
+            sizes = [FPGA_CHUNK_SIZES[-1]]
+        if configured:
+            # only remember a chunk size that produced a working FPGA
+            _fpga_chunk_size[type(self)] = chunk_size
+        t_done = time.time()
+        return FirmwareUploadStats(len(rbf), chunk_size, t_sent - t_start,
+                                   t_done - t_sent)
+
+    def __send_fpga_image(self, rbf, sizes):
+        """
+        Unlock the FPGA upload and transmit the image in chunks using
+        command 0x51, falling back to smaller chunks if the device rejects
+        a transfer. Returns the chunk size of the last transfer.
+        :param rbf: the FPGA image
+        :param sizes: the chunk sizes to try, largest first; rejected
+        sizes are removed
+        """
+        # Send FW upload unlock code 0xAD
+        self.send_message('DEV:FPGACFG=0xAD')
+        pos = 0
+        while pos < len(rbf):
+            msg = rbf[pos:pos + sizes[0]]
+            try:
+                sent = self.dev.ctrl_transfer(_REQUEST_OUT, 0x51, 0, 0, msg)
+            except usb.core.USBError:
+                if len(sizes) == 1:
+                    raise
+                sent = 0
+            if sent != len(msg):
+                if sent or len(sizes) == 1:
+                    raise IOError("FPGA image upload failed")
+                sizes.pop(0)
+                continue
+            pos += sent
+        return sizes[0]
+
+    def __wait_fpga_configured(self):
+        """
+        Poll the configuration status instead of a fixed pause and return
+        whether the FPGA was configured within FPGA_CONFIG_TIMEOUT.
+        """
+        t_sent = time.time()
+        delay = FPGA_POLL_MIN_DELAY
+        while time.time() < t_sent + FPGA_CONFIG_TIMEOUT:
+            time.sleep(delay)
+            try:
+                if self.send_message('?DEV:FPGACFG') == \
+                        'DEV:FPGACFG=CONFIGURED':
+                    return True
+            except IOError:
+                # the device may not answer while the FPGA starts up
+                pass
+            delay = min(delay * 2, FPGA_POLL_MAX_DELAY)
+        return False
+
+    def __get_interface(self, entry=None):
+        """
+        Get the USB interface descriptor.
+        :param entry: a device cache entry to use and update
+        """
         cfg = self.dev.get_active_configuration()
-        intf_number = cfg[(0, 0)].bInterfaceNumber
-        alternate_setting = usb.control.get_interface(self.dev, intf_number)
+        if entry is not None and 'interface' in entry:
+            intf_number, alternate_setting = entry['interface']
+        else:
+            intf_number = cfg[(0, 0)].bInterfaceNumber
+            alternate_setting = usb.control.get_interface(self.dev,
+                                                          intf_number)
+            if entry is not None:
+                entry['interface'] = [intf_number, alternate_setting]
         return usb.util.find_descriptor(cfg, bInterfaceNumber=intf_number,
                                         bAlternateSetting=alternate_setting)
 
-    def __get_bulk_endpoint(self, direction):
+    def __get_bulk_endpoint(self, direction, entry=None):
         """
         Get the USB endpoint for bulk read or write.
         :param direction: ENDPOINT_IN or ENDPOINT_OUT
+        :param entry: a device cache entry to use and update
         """
 
         def ep_match(endp):
@@ -241,7 +792,72 @@ class MCCDevice(object):
             return (usb.util.endpoint_direction(endp.bEndpointAddress) ==
                     direction) and (endp.bDescriptorType == 5)
 
-        return usb.util.find_descriptor(self._intf, custom_match=ep_match)
+        key = 'endpoint_in' if direction == usb.util.ENDPOINT_IN else \
+            'endpoint_out'
+        if entry is not None and key in entry:
+            if entry[key] is None:
+                return None
+            return usb.util.find_descriptor(self._intf,
+                                            bEndpointAddress=entry[key])
+        endpoint = usb.util.find_descriptor(self._intf,
+                                            custom_match=ep_match)
+        if entry is not None:
+            entry[key] = endpoint.bEndpointAddress if endpoint else None
+        return endpoint
+
+    def __load_cache_entry(self):
+        """
+        Restore the cached information of this device if the entry is
+        valid for the connected firmware, otherwise start a new entry.
+        """
+        serial = self.dev.serial_number
+        entry = self._device_cache.load(self.id_product, serial)
+        if entry is not None:
+            responses = entry.get('responses', {})
+            if self.send_message('?DEV:FWV') != responses.get('?DEV:FWV'):
+                # stale entry, e.g. after a firmware update
+                self._device_cache.invalidate(self.id_product, serial)
+                entry = None
+        if entry is None:
+            return {'serial_number': serial, 'created': time.time()}
+        self._response_cache.update(responses)
+        for channel, range_, slope, offset in entry.get('calibration', []):
+            self._calib_cache[(channel, range_)] = (slope, offset)
+        if entry.get('fpga_chunk_size'):
+            _fpga_chunk_size.setdefault(type(self), entry['fpga_chunk_size'])
+        return entry
+
+    @contextlib.contextmanager
+    def __cache_batch(self):
+        """Write the cache entry changed within the block only once."""
+        self._cache_batch_depth += 1
+        try:
+            yield
+        finally:
+            self._cache_batch_depth -= 1
+            if not self._cache_batch_depth and self._cache_dirty:
+                self._cache_dirty = False
+                self.__save_cache_entry()
+
+    def __cache_changed(self):
+        """Write the changed cache entry, at the end of a batch if any."""
+        if self._cache_entry is None:
+            return
+        if self._cache_batch_depth:
+            self._cache_dirty = True
+        else:
+            self.__save_cache_entry()
+
+    def __save_cache_entry(self):
+        """Write the information learned about this device to the cache."""
+        entry = self._cache_entry
+        entry['responses'] = dict(self._response_cache)
+        entry['calibration'] = [
+            [channel, range_, slope, offset] for (channel, range_),
+            (slope, offset) in sorted(self._calib_cache.items())]
+        entry['fpga_chunk_size'] = _fpga_chunk_size.get(type(self))
+        self._device_cache.store(self.id_product, entry['serial_number'],
+                                 entry)
 
 
 class USB_7202(MCCDevice):
@@ -0,0 +1,200 @@
+# coding=utf-8
+"""
+Parallel acquisition with several DAQFlex devices.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Thread, Barrier
+
+
+class DeviceGroup(object):
+    """
+    A set of devices of the same model that are opened, configured and
+    streamed in parallel. Every device keeps its own polling thread, so
+    aggregate throughput scales with the number of devices.
+    """
+
+    def __init__(self, device_class, serial_numbers=None, max_workers=None,
+                 **kwargs):
+        """
+        Connect to all devices in parallel (including FPGA upload).
+        :param device_class: the MCCDevice subclass of the devices
+        :param serial_numbers: serial numbers of the devices to open
+        (default = None, all attached devices of this model)
+        :param max_workers: size of the thread pool
+        (default = None, one thread per device)
+        Further keyword arguments are passed to the device constructor.
+        """
+        if serial_numbers is None:
+            serial_numbers = device_class.find_serial_numbers()
+        if not serial_numbers:
+            raise ValueError('No devices to open')
+        self.serial_numbers = list(serial_numbers)
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers or len(self.serial_numbers))
+        futures = [self._pool.submit(device_class, serial, **kwargs)
+                   for serial in self.serial_numbers]
+        errors = [future.exception() for future in futures]
+        if any(err is not None for err in errors):
+            # release the devices that did open, as close() does
+            for future, err in zip(futures, errors):
+                if err is None:
+                    future.result().stop_continuous_transfer()
+            self._pool.shutdown(wait=True)
+            raise next(err for err in errors if err is not None)
+        self.devices = dict(zip(self.serial_numbers,
+                                [future.result() for future in futures]))
+        self.start_times = {}
+        self._blocks = Queue()
+        self._notifiers = []
+        self._streams = 0
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __getitem__(self, serial_number):
+        return self.devices[serial_number]
+
+    def _map(self, func, items):
+        """Run func on all items in the thread pool and return the results."""
+        return list(self._pool.map(func, items))
+
+    def send_messages(self, messages):
+        """
+        Send command messages to all devices in parallel.
+        :param messages: list of commands for every device, or a dict
+        of serial number -> list of commands
+        :returns: dict of serial number -> list of responses
+        """
+        if isinstance(messages, dict):
+            get_messages = messages.__getitem__
+        else:
+            get_messages = lambda serial: messages
+        return dict(zip(self.serial_numbers, self._map(
+            lambda serial: self.devices[serial].send_messages(
+                get_messages(serial)), self.serial_numbers)))
+
+    def start(self, rate, buf_size, packet_size=None, queue_depth=None,
+              command='AISCAN:START'):
+        """
+        Start the continuous transfer on all devices, then send the start
+        command to all devices at once to minimize the start skew.
+        See MCCDevice.start_continuous_transfer for the parameters.
+        :param command: the command that starts the scan
+        (default = 'AISCAN:START')
+        """
+        self._map(lambda dev: dev.start_continuous_transfer(
+            rate, buf_size, packet_size, queue_depth),
+            self.devices.values())
+        self._notifiers = []
+        self._streams = len(self.devices)
+        for serial, dev in self.devices.items():
+            notifier = Thread(target=self._notify,
+                              args=(serial, dev._polling_thread))
+            notifier.daemon = True
+            notifier.start()
+            self._notifiers.append(notifier)
+        # one thread per device, the pool may be smaller than the barrier
+        barrier = Barrier(len(self.devices))
+        errors = []
+
+        def start_device(serial):
+            try:
+                barrier.wait()
+                self.start_times[serial] = time.time()
+                self.devices[serial].send_message(command)
+            except Exception as err:
+                errors.append(err)
+                barrier.abort()
+
+        starters = [Thread(target=start_device, args=(serial,))
+                    for serial in self.serial_numbers]
+        for starter in starters:
+            starter.daemon = True
+            starter.start()
+        for starter in starters:
+            starter.join()
+        if errors:
+            raise errors[0]
+
+    @property
+    def start_skew(self):
+        """Time between the first and the last start command in seconds."""
+        if not self.start_times:
+            return None
+        return max(self.start_times.values()) - min(self.start_times.values())
+
+    def stop(self, command='AISCAN:STOP'):
+        """
+        Stop the scan and the continuous transfer on all devices.
+        :param command: the command that stops the scan
+        (default = 'AISCAN:STOP')
+        """
+        def stop_device(dev):
+            dev.send_message(command)
+            dev.stop_continuous_transfer()
+
+        self._map(stop_device, self.devices.values())
+        for notifier in self._notifiers:
+            notifier.join()
+        self._notifiers = []
+
+    def iter_blocks(self, timeout=None):
+        """
+        Iterate over (serial number, data block) pairs from all devices in
+        the order in which new data arrives, until every transfer has ended.
+        :param timeout: stop iterating if no device delivers data within
+        timeout seconds (default = None, wait indefinitely)
+        """
+        while self._streams:
+            try:
+                serial = self._blocks.get(timeout=timeout)
+            except Empty:
+                return
+            if serial is None:
+                self._streams -= 1
+                continue
+            data = self.devices[serial].data_buffer.read()
+            if data:
+                yield serial, data
+
+    def close(self):
+        """Stop all transfers and shut down the thread pool."""
+        for dev in self.devices.values():
+            dev.stop_continuous_transfer()
+        self._pool.shutdown(wait=True)
+
+    def _notify(self, serial, reader):
+        """Queue a notification whenever reader delivers new data."""
+        while reader.is_alive():
+            if reader.new_data.wait(0.1):
+                reader.new_data.clear()
+                self._blocks.put(serial)
+        self._blocks.put(serial)
+        self._blocks.put(None)
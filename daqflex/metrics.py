@@ -0,0 +1,162 @@
+# coding=utf-8
+"""
+Throughput, latency and buffer level metrics of continuous transfers.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import collections
+import time
+from threading import Thread, Event
+
+# upper edges of the read latency histogram buckets in microseconds,
+# powers of two from 64 us to about 1 s; the last bucket is open ended
+LATENCY_BUCKETS = tuple(1 << n for n in range(6, 21))
+
+MetricsSnapshot = collections.namedtuple('MetricsSnapshot', [
+    'time', 'elapsed', 'packets', 'bytes', 'timeouts', 'errors',
+    'packets_per_second', 'bytes_per_second', 'latency_histogram',
+    'max_latency', 'fill_level', 'capacity', 'high_water', 'dropped',
+    'consumer_lag'])
+MetricsSnapshot.__doc__ = """
+Counters of a continuous transfer at one point in time.
+Rates are averages since the start of the transfer; use interval_rates()
+for the rates between two snapshots. latency_histogram holds the number
+of read calls per LATENCY_BUCKETS entry plus one open ended bucket.
+consumer_lag is the unread buffer content in seconds of acquisition.
+"""
+
+
+def interval_rates(older, newer):
+    """
+    Return (packets_per_second, bytes_per_second) between two snapshots.
+    :param older: the earlier MetricsSnapshot
+    :param newer: the later MetricsSnapshot
+    """
+    span = newer.time - older.time
+    if span <= 0:
+        return 0.0, 0.0
+    return ((newer.packets - older.packets) / span,
+            (newer.bytes - older.bytes) / span)
+
+
+class AcquisitionMetrics(object):
+    """
+    Counters updated by a polling thread for every bulk read.
+
+    Recording a read costs a few integer updates and no allocation, so
+    the metrics are always enabled. Only the reading thread writes the
+    counters; snapshot() may be called from any thread and returns
+    an immutable MetricsSnapshot.
+    """
+
+    def __init__(self, data_buf, rate, channels=1):
+        """
+        :param data_buf: the SampleRingBuffer receiving the samples
+        :param rate: the sample rate of the AISCAN command in Hz
+        :param channels: the number of channels per scan (default = 1)
+        """
+        self.data_buffer = data_buf
+        self.rate = rate
+        self.channels = channels
+        self.t_start = time.time()
+        self.packets = 0
+        self.bytes = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.max_latency = 0.0
+        self.high_water = 0
+        self._histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record_read(self, length, latency):
+        """
+        Account for a completed read call.
+        :param length: the number of bytes received
+        :param latency: the duration of the read call in seconds
+        """
+        self.packets += 1
+        self.bytes += length
+        micros = int(latency * 1e6)
+        bucket = (micros - 1).bit_length() - 6 if micros > 64 else 0
+        self._histogram[min(bucket, len(LATENCY_BUCKETS))] += 1
+        if latency > self.max_latency:
+            self.max_latency = latency
+        level = len(self.data_buffer)
+        if level > self.high_water:
+            self.high_water = level
+
+    def record_timeout(self):
+        """Account for a read call that timed out without data."""
+        self.timeouts += 1
+
+    def record_error(self):
+        """Account for a failed read call."""
+        self.errors += 1
+
+    def snapshot(self):
+        """Return the current counters as a MetricsSnapshot."""
+        now = time.time()
+        elapsed = now - self.t_start
+        packets = self.packets
+        nbytes = self.bytes
+        level = len(self.data_buffer)
+        return MetricsSnapshot(
+            time=now, elapsed=elapsed, packets=packets, bytes=nbytes,
+            timeouts=self.timeouts, errors=self.errors,
+            packets_per_second=packets / elapsed if elapsed else 0.0,
+            bytes_per_second=nbytes / elapsed if elapsed else 0.0,
+            latency_histogram=tuple(self._histogram),
+            max_latency=self.max_latency, fill_level=level,
+            capacity=self.data_buffer.capacity, high_water=self.high_water,
+            dropped=self.data_buffer.dropped,
+            consumer_lag=level / float(self.rate * self.channels))
+
+
+class MetricsExporter(Thread):
+    """Thread passing a snapshot of AcquisitionMetrics to a callback."""
+
+    def __init__(self, metrics, callback, interval=1.0):
+        """
+        :param metrics: the AcquisitionMetrics to export
+        :param callback: function called with each MetricsSnapshot
+        :param interval: export interval in seconds (default = 1.0)
+        """
+        super(MetricsExporter, self).__init__()
+        self.daemon = True
+        self.metrics = metrics
+        self.callback = callback
+        self.interval = interval
+        self.shutdown = Event()
+
+    def stop(self):
+        """Export a final snapshot and end the thread."""
+        self.shutdown.set()
+        self.join()
+
+    def run(self):
+        while not self.shutdown.wait(self.interval):
+            self.callback(self.metrics.snapshot())
+        self.callback(self.metrics.snapshot())
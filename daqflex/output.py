@@ -0,0 +1,215 @@
+# coding=utf-8
+"""
+Hardware-paced analog output streaming (AOSCAN) over the bulk OUT endpoint.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import array
+import errno
+import time
+from queue import Queue, Empty
+from threading import Thread, Event, Lock
+from .utils import usb
+
+
+def volts_to_counts(volts, min_voltage=-10.0, max_voltage=10.0,
+                    max_counts=0xFFFF):
+    """
+    Convert output voltages (number or numpy array) to raw DAC counts.
+    :param volts: the voltages
+    :param min_voltage: the voltage of count 0 (default = -10.0)
+    :param max_voltage: the voltage of max_counts (default = 10.0)
+    :param max_counts: the full scale count value (default = 0xFFFF)
+    """
+    import numpy
+    counts = (numpy.asarray(volts, dtype=numpy.float64) - min_voltage) / \
+        (max_voltage - min_voltage) * max_counts
+    return numpy.clip(numpy.round(counts), 0, max_counts).astype(
+        numpy.uint16)
+
+
+def _as_samples(samples):
+    """Copy uint16 samples (array, numpy array, bytes) into an array."""
+    data = array.array('H')
+    view = memoryview(samples)
+    data.frombytes(view.cast('B') if view.format != 'B' else view)
+    return data
+
+
+class OutputStream(Thread):
+    """
+    Thread streaming AOSCAN samples to the bulk OUT endpoint.
+
+    Samples come either from a queue of blocks filled with write(), which
+    holds at most ``buffers`` blocks (double buffering by default), or
+    from a waveform set with set_waveform() that is repeated until it is
+    replaced or the stream is closed. A new waveform takes over at the
+    end of the current period, so it can be refilled on the fly.
+
+    If the queue runs empty while the device still needs data, the
+    stream index is recorded in ``underruns``; the device then stops the
+    scan with status UNDERRUN and the next write fails, which ends the
+    thread with the error in ``error``.
+    """
+
+    def __init__(self, endpoint, rate, channels=1, packet_size=None,
+                 buffers=2, timeout=1000):
+        """
+        :param endpoint: the bulk OUT endpoint
+        :param rate: the AOSCAN rate in Hz (scans per second)
+        :param channels: the number of output channels per scan
+        :param packet_size: the size of a bulk write in bytes
+        (default = None, about 10 ms of data)
+        :param buffers: the number of blocks the write queue holds
+        (default = 2)
+        :param timeout: the timeout of a bulk write in ms (default = 1000)
+        """
+        super(OutputStream, self).__init__()
+        self.daemon = True
+        self.endpoint = endpoint
+        self.rate = rate
+        self.channels = channels
+        if packet_size is None:
+            packet_size = (int(rate * channels) // 100 // 32 + 1) * 64
+        self.packet_size = packet_size
+        self.timeout = timeout
+        self.samples_written = 0
+        self.underruns = []
+        self.error = None
+        self.shutdown = Event()
+        self.primed = Event()
+        self.t_start = None
+        self._queue = Queue(buffers)
+        self._closed = False
+        self._lock = Lock()
+        self._waveform = None
+        self._next_waveform = None
+
+    def write(self, samples, timeout=None):
+        """
+        Queue a block of uint16 samples (interleaved by channel), waiting
+        while the queue is full.
+        :param samples: the samples (array, numpy array or bytes)
+        :param timeout: maximum wait in seconds (default = None, no limit)
+        """
+        if self.error is not None:
+            raise self.error
+        self._queue.put(_as_samples(samples), timeout=timeout)
+
+    def set_waveform(self, samples):
+        """
+        Repeat a waveform of uint16 samples (interleaved by channel).
+        Replaces the current waveform at the end of its period.
+        :param samples: the samples of one period
+        """
+        data = _as_samples(samples)
+        if not data:
+            raise ValueError('waveform must not be empty')
+        with self._lock:
+            self._next_waveform = data
+
+    def close(self):
+        """Write the queued data and end the thread (finite output)."""
+        self._closed = True
+        with self._lock:
+            self._next_waveform = None
+            self._waveform = None
+
+    def stop(self):
+        """Stop writing immediately and wait for the thread to end."""
+        self.shutdown.set()
+        self.join()
+
+    def started(self):
+        """Mark the start of the device scan, for underrun detection."""
+        self.t_start = time.time()
+
+    def run(self):
+        try:
+            while not self.shutdown.is_set():
+                data = self._next_block()
+                if data is None:
+                    break
+                self._write(memoryview(data).cast('B'))
+        except usb.core.USBError as err:
+            self.error = err
+        finally:
+            self.primed.set()
+
+    def _next_block(self):
+        """Return the next period of the waveform or the next block."""
+        with self._lock:
+            if self._next_waveform is not None:
+                self._waveform, self._next_waveform = \
+                    self._next_waveform, None
+            if self._waveform is not None:
+                return self._waveform
+        starved = False
+        while not self.shutdown.is_set():
+            margin = self._margin()
+            wait = 0.01 if margin is None else min(max(margin, 0.001), 0.01)
+            try:
+                return self._queue.get(timeout=wait)
+            except Empty:
+                if self._closed and self._queue.empty():
+                    return None
+                with self._lock:
+                    if self._next_waveform is not None:
+                        return self._next_block()
+                if not starved and margin is not None and margin <= 0:
+                    # the device has played all data written so far
+                    self.underruns.append(self.samples_written)
+                    starved = True
+        return None
+
+    def _margin(self):
+        """
+        Seconds until the device has output all written samples, or None
+        before the scan was started.
+        """
+        if self.t_start is None:
+            return None
+        played = (time.time() - self.t_start) * self.rate * self.channels
+        return (self.samples_written - played) / \
+            float(self.rate * self.channels)
+
+    def _write(self, data):
+        """Write a block to the endpoint in packets."""
+        pos = 0
+        while pos < len(data) and not self.shutdown.is_set():
+            chunk = data[pos:pos + self.packet_size]
+            try:
+                length = self.endpoint.write(chunk, self.timeout)
+            except usb.core.USBError as err:
+                if err.errno != errno.ETIMEDOUT:
+                    raise
+                # the FIFO is full, e.g. before the scan was started
+                length = 0
+            pos += length
+            self.samples_written += length // 2
+            if length:
+                self.primed.set()
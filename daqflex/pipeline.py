@@ -0,0 +1,265 @@
+# coding=utf-8
+"""
+Push-based processing pipeline for continuous transfer data.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+from queue import Queue
+from threading import Thread, Event, Lock
+from .utils import DataBlock
+
+# marker passed through the stage queues to end the workers
+_STOP = object()
+
+
+def calibration_stage(calibration):
+    """
+    Return a stage function converting raw DataBlocks to voltages with a
+    ScanCalibration, using the sequence number for the channel phase.
+    :param calibration: the ScanCalibration of the scanned channels
+    """
+    def calibrate(block):
+        phase = block.sequence % calibration.channels
+        return DataBlock(block.sequence,
+                         calibration.convert(block.data, phase=phase))
+    return calibrate
+
+
+class Stage(object):
+    """
+    A processing step of a Pipeline, run by a pool of worker threads.
+
+    The stage function is called with each item (a DataBlock for the
+    first stage) and returns the item for the next stages, or None to
+    pass nothing on. With several workers, results are passed on in the
+    order of their input. numpy releases the GIL for most operations on
+    large arrays, so workers of numeric stages run on multiple cores.
+    """
+
+    def __init__(self, func, workers=1, queue_size=16, name=None):
+        """
+        :param func: the stage function
+        :param workers: number of worker threads (default = 1)
+        :param queue_size: maximum number of items waiting for this stage;
+        a full queue makes the previous stage wait (default = 16)
+        :param name: name for error messages (default = None, use the
+        function name)
+        """
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self.func = func
+        self.workers = workers
+        self.name = name or getattr(func, '__name__', 'stage')
+        self.queue = Queue(queue_size)
+        self.processed = 0
+        self.errors = 0
+        self.error = None
+        self._next = []
+        self._threads = []
+        self._order_lock = Lock()
+        self._pending = {}
+        self._emit_index = 0
+
+    def start(self, next_stages):
+        """
+        Start the worker threads.
+        :param next_stages: the Stage receiving the results, a list of
+        Stages that all receive them, or None
+        """
+        if next_stages is None:
+            next_stages = []
+        elif isinstance(next_stages, Stage):
+            next_stages = [next_stages]
+        self._next = list(next_stages)
+        for num in range(self.workers):
+            thread = Thread(target=self._work,
+                            name='{0}-{1}'.format(self.name, num))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Process all queued items and end the worker threads."""
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            index, data = item
+            try:
+                result = self.func(data)
+            except Exception as err:
+                self.errors += 1
+                if self.error is None:
+                    self.error = err
+                result = None
+            self._emit(index, result)
+
+    def _emit(self, index, result):
+        """Pass results on to the next stage in input order."""
+        with self._order_lock:
+            self._pending[index] = result
+            while self._emit_index in self._pending:
+                result = self._pending.pop(self._emit_index)
+                if result is not None:
+                    self.processed += 1
+                    for stage in self._next:
+                        stage.queue.put((self._emit_index, result))
+                self._emit_index += 1
+
+
+class Pipeline(object):
+    """
+    Push-based processing of continuous transfer data.
+
+    A source thread is woken by the polling thread whenever new data is
+    buffered, takes all contiguous data out of the SampleRingBuffer as
+    DataBlocks and feeds them into a chain of Stages connected by
+    bounded queues. A tuple at the end of a chain fans out: each of its
+    branches (a stage, or a list of stages) gets every result of the
+    previous stage, so independent consumers run in parallel::
+
+        Pipeline([calibration_stage(cal), (save, [spectrum, plot])])
+
+    Branches share the items, so stage functions must not modify their
+    input in place. A slow stage fills the queues and then the ring
+    buffer, whose overflow policy decides what happens; USB reads are
+    never blocked by processing (unless the 'block' policy is chosen).
+    """
+
+    def __init__(self, stages, block_samples=None):
+        """
+        :param stages: list of Stage objects or stage functions (which
+        get a single worker), optionally ending with a tuple of branches
+        :param block_samples: maximum number of samples per DataBlock
+        (default = None, all available data)
+        """
+        # all Stages in the order given, and where their results go
+        self.stages = []
+        self._heads = []
+        self._links = {}
+        self._chain(list(stages), None)
+        if not self.stages:
+            raise ValueError('at least one stage is required')
+        self.block_samples = block_samples
+        self.blocks = 0
+        self.error = None
+        self.data_buffer = None
+        self._wakeup = Event()
+        self._shutdown = Event()
+        self._source = None
+        self._reader = None
+
+    def _chain(self, chain, previous):
+        """
+        Create the Stages of a chain and connect them in order.
+        :param chain: list of stages, optionally ending with a tuple of
+        branches
+        :param previous: the Stage feeding the chain, or None for the
+        source thread
+        """
+        for pos, item in enumerate(chain):
+            if isinstance(item, tuple):
+                if pos != len(chain) - 1:
+                    raise ValueError('branches must end a chain')
+                for branch in item:
+                    self._chain(branch if isinstance(branch, list)
+                                else [branch], previous)
+                return
+            stage = item if isinstance(item, Stage) else Stage(item)
+            self.stages.append(stage)
+            if previous is None:
+                self._heads.append(stage)
+            else:
+                self._links.setdefault(previous, []).append(stage)
+            previous = stage
+
+    def attach(self, reader):
+        """
+        Start processing the data of a polling thread.
+        :param reader: the PollingThread or AsyncBulkReader to follow
+        """
+        self.data_buffer = reader.data_buffer
+        self._reader = reader
+        for stage in self.stages:
+            stage.start(self._links.get(stage))
+        self._source = Thread(target=self._feed, name='pipeline-source')
+        self._source.daemon = True
+        self._source.start()
+        reader.listeners.append(self._wakeup.set)
+
+    def stop(self):
+        """
+        Process all buffered data and end all threads. Raises the first
+        exception of a stage function, or the error that ended the data
+        of the buffer (e.g. the BufferOverflowError of the 'raise'
+        overflow policy).
+        """
+        if self._source is None:
+            return
+        self._shutdown.set()
+        self._wakeup.set()
+        self._source.join()
+        self._source = None
+        self._reader.listeners.remove(self._wakeup.set)
+        for stage in self.stages:
+            stage.stop()
+        for stage in self.stages:
+            if stage.error is not None:
+                raise stage.error
+        if self.error is not None:
+            raise self.error
+        if self.data_buffer.error is not None:
+            raise self.data_buffer.error
+
+    def _feed(self):
+        while True:
+            self._wakeup.wait()
+            # clear before reading, so data arriving meanwhile wakes us
+            self._wakeup.clear()
+            finished = self._shutdown.is_set()
+            while self.data_buffer:
+                try:
+                    block = self.data_buffer.read_block(self.block_samples)
+                except Exception as err:
+                    # the end of the stream, raised by stop()
+                    self.error = err
+                    return
+                if not block.data:
+                    # overwritten while copying, recorded as a gap
+                    continue
+                for stage in self._heads:
+                    stage.queue.put((self.blocks, block))
+                self.blocks += 1
+            if finished:
+                return
@@ -0,0 +1,437 @@
+# coding=utf-8
+"""
+Out-of-process acquisition with a shared-memory sample ring.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import array
+import multiprocessing
+import os
+from multiprocessing import resource_tracker, shared_memory
+from .devices import MCCDevice, default_packet_size
+
+# layout of the shared memory block: 64-bit counters, then the samples
+_HEAD, _TAIL, _DROPPED, _CAPACITY = range(4)
+_DATA_OFFSET = 64
+
+
+def _attach(name):
+    """
+    Attach to an existing shared memory block without taking over the
+    removal at exit, which stays with the creating process.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13, attaching registers the block with the
+        # resource tracker. Child processes share the tracker of their
+        # parent (see ProcessDevice), where the creator registered it
+        # already, so this changes nothing; unregistering here would
+        # remove the creator's registration.
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedSampleRing(object):
+    """
+    Single-producer, single-consumer sample ring in shared memory.
+
+    The header holds 64-bit ``head`` (samples written) and ``tail``
+    (samples consumed) counters. Each counter is written by one side
+    only, after the sample data it covers has been copied, so the
+    producer and the consumer need no lock. A full ring drops the newest
+    samples, counted in ``dropped``; the producer never waits for the
+    consumer. Provides the part of the SampleRingBuffer interface used
+    by the polling threads and by get_new_bulk_data/peek consumers.
+
+    The ring keeps no stream indices: there is no ``gaps``, ``skip``,
+    ``fail`` or ``read_block``, so get_new_bulk_block, get_transfer_gaps,
+    StreamSupervisor and Pipeline need a SampleRingBuffer in the
+    consumer's process.
+    """
+    typecode = 'H'
+
+    def __init__(self, capacity=None, name=None):
+        """
+        Create a new ring, or attach to an existing one by name.
+        :param capacity: the number of samples (for a new ring)
+        :param name: the shared memory name (to attach to a ring)
+        """
+        if name is None:
+            if not capacity or capacity <= 0:
+                raise ValueError('capacity must be positive')
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=_DATA_OFFSET + 2 * int(capacity))
+            self.owner = True
+        else:
+            self._shm = _attach(name)
+            self.owner = False
+        self.name = self._shm.name
+        self._header = self._shm.buf[:_DATA_OFFSET].cast('q')
+        if self.owner:
+            self._header[_HEAD] = self._header[_TAIL] = 0
+            self._header[_DROPPED] = 0
+            self._header[_CAPACITY] = int(capacity)
+        self.capacity = self._header[_CAPACITY]
+        self._view = self._shm.buf[_DATA_OFFSET:_DATA_OFFSET +
+                                   2 * self.capacity].cast(self.typecode)
+
+    def __reduce__(self):
+        # pickled (e.g. sent to a child process) as a reference by name
+        return SharedSampleRing, (None, self.name)
+
+    @property
+    def head(self):
+        return self._header[_HEAD]
+
+    @property
+    def tail(self):
+        return self._header[_TAIL]
+
+    @property
+    def dropped(self):
+        return self._header[_DROPPED]
+
+    def __len__(self):
+        return self._header[_HEAD] - self._header[_TAIL]
+
+    def __bool__(self):
+        return len(self) > 0
+
+    __nonzero__ = __bool__
+
+    @property
+    def free(self):
+        """Number of samples that can be written without dropping data."""
+        return self.capacity - len(self)
+
+    def write(self, samples):
+        """
+        Copy samples into the ring (producer side), dropping the newest
+        samples that do not fit.
+        :param samples: uint16 samples supporting the buffer protocol
+        :returns: the number of samples written
+        """
+        src = memoryview(samples)
+        if src.format != self.typecode:
+            src = src.cast('B').cast(self.typecode)
+        head = self._header[_HEAD]
+        count = min(len(src), self.capacity - (head - self._header[_TAIL]))
+        if count < len(src):
+            self._header[_DROPPED] += len(src) - count
+        pos = head % self.capacity
+        first = min(count, self.capacity - pos)
+        self._view[pos:pos + first] = src[:first]
+        if first < count:
+            self._view[:count - first] = src[first:count]
+        self.commit(count)
+        return count
+
+    def write_view(self, count):
+        """
+        Return a writable memoryview of count free samples at the write
+        position (producer side), or None if they wrap around the end of
+        the ring or do not fit. See SampleRingBuffer.write_view.
+        :param count: the number of samples
+        """
+        head = self._header[_HEAD]
+        pos = head % self.capacity
+        if count > min(self.capacity - pos,
+                       self.capacity - (head - self._header[_TAIL])):
+            return None
+        return self._view[pos:pos + count]
+
+    def commit(self, count):
+        """
+        Publish samples copied to the write position (producer side).
+        :param count: the number of samples
+        """
+        # publish the samples only after they have been copied
+        self._header[_HEAD] += count
+
+    def peek(self, count=None):
+        """
+        Return one or two memoryviews of unread samples in the shared
+        memory, without copying or consuming them (consumer side).
+        :param count: the maximum number of samples (default = None, all)
+        """
+        tail = self._header[_TAIL]
+        available = self._header[_HEAD] - tail
+        if count is None or count > available:
+            count = available
+        pos = tail % self.capacity
+        first = min(count, self.capacity - pos)
+        if first == count:
+            return (self._view[pos:pos + count],)
+        return self._view[pos:], self._view[:count - first]
+
+    def consume(self, count):
+        """
+        Release samples to the producer, e.g. after processing peek().
+        :param count: the number of samples
+        """
+        tail = self._header[_TAIL]
+        self._header[_TAIL] = min(tail + count, self._header[_HEAD])
+
+    def read(self, count=None):
+        """
+        Copy unread samples into a new array and consume them.
+        :param count: the maximum number of samples (default = None, all)
+        """
+        data = array.array(self.typecode)
+        views = self.peek(count)
+        for view in views:
+            data.frombytes(view.cast('B'))
+        self.consume(len(data))
+        return data
+
+    def readinto(self, buf):
+        """
+        Copy unread samples into a preallocated buffer and consume them.
+        :param buf: writable uint16 buffer (e.g. array or numpy array)
+        :returns: the number of samples copied
+        """
+        dst = memoryview(buf).cast('B').cast(self.typecode)
+        pos = 0
+        for view in self.peek(len(dst)):
+            dst[pos:pos + len(view)] = view
+            pos += len(view)
+        self.consume(pos)
+        return pos
+
+    def close(self):
+        """
+        Writer release called by stop_continuous_transfer; the producer
+        never blocks, so there is nothing to wake up.
+        """
+
+    def __del__(self):
+        try:
+            self.release()
+        except (AttributeError, BufferError):
+            pass
+
+    def release(self):
+        """
+        Detach from the shared memory; the owner also removes it. Views
+        returned by peek() must be released before.
+        """
+        shm, self._shm = self._shm, None
+        if shm is None:
+            return
+        if self.owner:
+            shm.unlink()
+        self._header.release()
+        self._view.release()
+        shm.close()
+
+
+def _send_error(conn, err):
+    try:
+        conn.send((False, err))
+    except Exception:
+        # the exception cannot be pickled
+        conn.send((False, IOError(repr(err))))
+
+
+def _serve(conn, notify, factory, args, kwargs):
+    """Child process: own the device and execute the parent's requests."""
+    try:
+        dev = factory(*args, **kwargs)
+    except Exception as err:
+        _send_error(conn, err)
+        return
+    conn.send((True, None))
+    while True:
+        method, margs, mkwargs = conn.recv()
+        if method is None:
+            break
+        try:
+            if (method == 'start_continuous_transfer' and
+                    isinstance(dev.data_buffer, SharedSampleRing)):
+                dev.stop_continuous_transfer()
+                dev.data_buffer.release()
+            result = getattr(dev, method)(*margs, **mkwargs)
+            if method == 'start_continuous_transfer':
+                dev._polling_thread.listeners.append(notify.set)
+                result = None
+            elif method == 'stop_continuous_transfer':
+                notify.set()
+            conn.send((True, result))
+        except Exception as err:
+            _send_error(conn, err)
+    dev.stop_continuous_transfer()
+    if isinstance(dev.data_buffer, SharedSampleRing):
+        dev.data_buffer.release()
+    conn.close()
+
+
+class ProcessDevice(object):
+    """
+    Runs an MCCDevice in a separate process, so the USB reads never wait
+    for the GIL of the consumer process.
+
+    Commands are forwarded to the child process through a pipe. The
+    samples of a continuous transfer are published through a
+    SharedSampleRing that the consumer reads without copies (peek) or
+    with the usual get_new_bulk_data()::
+
+        dev = ProcessDevice(daqflex.USB_1608G)
+        dev.send_message("AISCAN:SAMPLES=0")
+        dev.start_continuous_transfer(100000, 100)
+        dev.send_message("AISCAN:START")
+        data = dev.get_new_bulk_data(wait=True)
+    """
+
+    def __init__(self, factory, *args, **kwargs):
+        """
+        Start the child process and open the device there.
+        :param factory: a picklable callable returning the MCCDevice,
+        e.g. the device class or simulator.open_simulated
+        Further arguments are passed to the factory.
+        """
+        ctx = multiprocessing.get_context()
+        if os.name == 'posix':
+            # start the resource tracker now, so that the child shares
+            # it also with the fork start method (see _attach)
+            resource_tracker.ensure_running()
+        self._conn, child_conn = ctx.Pipe()
+        self._notify = ctx.Event()
+        self.data_buffer = None
+        self._process = ctx.Process(
+            target=_serve, args=(child_conn, self._notify, factory, args,
+                                 kwargs))
+        self._process.daemon = True
+        self._process.start()
+        child_conn.close()
+        success, result = self._conn.recv()
+        if not success:
+            self._process.join()
+            self._process = None
+            raise result
+
+    def call(self, method, *args, **kwargs):
+        """
+        Call a method of the device in the child process and return the
+        result. Exceptions are raised in the parent.
+        :param method: the method name
+        """
+        self._conn.send((method, args, kwargs))
+        success, result = self._conn.recv()
+        if not success:
+            raise result
+        return result
+
+    def send_message(self, message):
+        """See MCCDevice.send_message."""
+        return self.call('send_message', message)
+
+    def send_messages(self, messages):
+        """See MCCDevice.send_messages."""
+        return self.call('send_messages', messages)
+
+    encode_message = staticmethod(MCCDevice.encode_message)
+
+    def send_encoded(self, payload):
+        """See MCCDevice.send_encoded."""
+        return self.call('send_encoded', payload)
+
+    def get_calib_data(self, channel):
+        """See MCCDevice.get_calib_data."""
+        return self.call('get_calib_data', channel)
+
+    def read_scan_data(self, length, rate):
+        """See MCCDevice.read_scan_data."""
+        return self.call('read_scan_data', length, rate)
+
+    def flush_input_data(self):
+        """See MCCDevice.flush_input_data."""
+        return self.call('flush_input_data')
+
+    def get_transfer_metrics(self):
+        """See MCCDevice.get_transfer_metrics."""
+        return self.call('get_transfer_metrics')
+
+    def start_continuous_transfer(self, rate, buf_size, packet_size=None,
+                                  queue_depth=None, channels=1):
+        """
+        Start the continuous transfer in the child process, writing to a
+        new shared memory ring of buf_size packets.
+        See MCCDevice.start_continuous_transfer for the parameters.
+        """
+        if packet_size is None:
+            packet_size = default_packet_size(rate * channels)
+        if self.data_buffer is not None:
+            self.data_buffer.release()
+        self.data_buffer = SharedSampleRing(buf_size * (packet_size // 2))
+        self._notify.clear()
+        self.call('start_continuous_transfer', rate, buf_size, packet_size,
+                  queue_depth, data_buffer=self.data_buffer,
+                  channels=channels)
+
+    def stop_continuous_transfer(self):
+        """Stop the continuous transfer; the buffered data stays readable."""
+        self.call('stop_continuous_transfer')
+
+    def get_clock_model(self):
+        """See MCCDevice.get_clock_model; returns a copy of the model."""
+        return self.call('get_clock_model')
+
+    def get_new_bulk_data(self, wait=False):
+        """
+        Return all continuous transfer data in the shared ring as a copy.
+        :param wait: if True, block until new data is available
+        """
+        if wait:
+            self._notify.wait()
+        self._notify.clear()
+        return self.data_buffer.read()
+
+    def peek_bulk_data(self, count=None):
+        """
+        Return memoryviews of unread samples in shared memory without
+        copying; call consume_bulk_data() after processing them.
+        :param count: the maximum number of samples (default = None, all)
+        """
+        return self.data_buffer.peek(count)
+
+    def consume_bulk_data(self, count):
+        """
+        Release samples returned by peek_bulk_data().
+        :param count: the number of samples
+        """
+        self.data_buffer.consume(count)
+
+    def close(self):
+        """Stop the child process and release the shared memory."""
+        if self._process is None:
+            return
+        self._conn.send((None, (), {}))
+        self._process.join()
+        self._process = None
+        self._conn.close()
+        if self.data_buffer is not None:
+            self.data_buffer.release()
+            self.data_buffer = None
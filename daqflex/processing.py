@@ -0,0 +1,377 @@
+# coding=utf-8
+"""
+Processing stages for interleaved multi-channel scan data.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import collections
+import numpy
+
+
+def as_samples(raw):
+    """Return raw uint16 data (array, memoryview or ndarray) as ndarray."""
+    if isinstance(raw, numpy.ndarray):
+        return raw
+    return numpy.frombuffer(raw, dtype=numpy.uint16)
+
+
+def _in_gap(gaps, index):
+    """Check whether a stream index lies in one of the (start, end) gaps."""
+    for start, end in reversed(gaps):
+        if start <= index:
+            return index < end
+    return False
+
+
+class ScanDemultiplexer(object):
+    """
+    Splits a stream of interleaved AISCAN samples into complete scans.
+
+    Blocks are returned as (scans, channels) views on the raw data, so
+    ``block[:, i]`` is a strided view of channel i without any copy.
+    A partial scan at the end of a block is carried over and completed
+    with the first samples of the next block; only this single stitched
+    scan is copied. With stream indices (DataBlock.sequence or the
+    buffer sequence), the scans stay aligned across lost samples.
+    """
+
+    def __init__(self, channels):
+        """
+        :param channels: the number of channels per scan
+        (HIGHCHAN - LOWCHAN + 1)
+        """
+        if channels < 1:
+            raise ValueError('channels must be at least 1')
+        self.channels = channels
+        self.scan_index = 0
+        self._leftover = numpy.empty(channels, dtype=numpy.uint16)
+        self._leftover_len = 0
+        self._pending = 0
+        self._pending_scans = 0
+        self._sequence = None
+
+    @property
+    def phase(self):
+        """Channel index of the next expected sample."""
+        return self._leftover_len
+
+    def reset(self):
+        """Discard partial scan state, e.g. after restarting the scan."""
+        self._leftover_len = 0
+        self._pending = 0
+        self._pending_scans = 0
+        self._sequence = None
+        self.scan_index = 0
+
+    def feed(self, raw, sequence=None):
+        """
+        Split a block of raw samples into complete scans.
+        :param raw: the next raw uint16 samples of the stream
+        :param sequence: the stream index of the first sample, e.g.
+        DataBlock.sequence; at the start and after a gap, the partial scan
+        is discarded and splitting resumes at the next scan boundary
+        (default = None, raw continues the previous block)
+        :returns: list of (scans, channels) arrays in stream order; all
+        but an optional first stitched scan are views on raw
+        """
+        data = as_samples(raw)
+        chans = self.channels
+        parts = []
+        if sequence is not None:
+            if sequence != self._sequence:
+                skip = -sequence % chans
+                data = data[skip:]
+                sequence += skip
+                self._leftover_len = 0
+                self.scan_index = sequence // chans
+            self._sequence = sequence + len(data)
+        if self._leftover_len:
+            need = chans - self._leftover_len
+            take = min(need, len(data))
+            self._leftover[self._leftover_len:self._leftover_len + take] = \
+                data[:take]
+            self._leftover_len += take
+            data = data[take:]
+            if self._leftover_len < chans:
+                return parts
+            parts.append(self._leftover.copy().reshape(1, chans))
+            self._leftover_len = 0
+        scans = len(data) // chans
+        if scans:
+            parts.append(data[:scans * chans].reshape(scans, chans))
+        rest = len(data) - scans * chans
+        if rest:
+            self._leftover[:rest] = data[scans * chans:]
+            self._leftover_len = rest
+        self.scan_index += sum(len(part) for part in parts)
+        return parts
+
+    def peek_buffer(self, data_buf):
+        """
+        Return the complete scans in a SampleRingBuffer up to the next gap
+        as views on the buffer storage, without consuming them. A partial
+        scan at the end stays in the buffer, the samples of a scan cut by
+        lost data are skipped; scan_index is the stream scan number of
+        the first scan. Call release() after processing the views.
+        If the buffer capacity is a multiple of the channel count, no data
+        is copied at all.
+        :param data_buf: the SampleRingBuffer of the continuous transfer
+        """
+        if self._leftover_len:
+            raise ValueError('cannot mix feed() and peek_buffer()')
+        chans = self.channels
+        block = data_buf.peek_block()
+        available = sum(len(view) for view in block.data)
+        # the buffer may start within a scan after lost samples
+        skip = min(-block.sequence % chans, available)
+        count = (available - skip) // chans * chans
+        self.scan_index = (block.sequence + skip) // chans
+        parts = []
+        carry = None
+        pos = 0
+        for view in block.data:
+            data = as_samples(view)[max(skip - pos, 0):
+                                    max(skip + count - pos, 0)]
+            pos += len(view)
+            if carry is not None:
+                # scan split by the buffer wrap-around
+                need = chans - len(carry)
+                parts.append(numpy.concatenate(
+                    (carry, data[:need])).reshape(1, chans))
+                data = data[need:]
+                carry = None
+            scans = len(data) // chans
+            if scans:
+                parts.append(data[:scans * chans].reshape(scans, chans))
+            if len(data) > scans * chans:
+                carry = data[scans * chans:]
+        self._pending = skip + count
+        if self._pending < available and \
+                _in_gap(data_buf.gaps, block.sequence + available):
+            # the partial scan before a gap is never completed
+            self._pending = available
+        self._pending_scans = count // chans
+        return parts
+
+    def release(self, data_buf):
+        """
+        Consume the scans returned by the last peek_buffer() call.
+        :param data_buf: the SampleRingBuffer passed to peek_buffer()
+        """
+        data_buf.consume(self._pending)
+        self.scan_index += self._pending_scans
+        self._pending = 0
+        self._pending_scans = 0
+
+
+class _BucketReducer(object):
+    """
+    Incremental min/max/sum reduction of rows into buckets of a fixed
+    number of rows, carrying a partial bucket across calls.
+    """
+
+    def __init__(self, channels, factor):
+        self.factor = factor
+        self._min = numpy.empty(channels)
+        self._max = numpy.empty(channels)
+        self._sum = numpy.zeros(channels)
+        self._fill = 0
+
+    def feed(self, mins, maxs, sums):
+        """
+        Reduce (rows, channels) arrays of minima, maxima and sums and
+        return (mins, maxs, sums) of all completed buckets.
+        """
+        factor = self.factor
+        rows = len(mins)
+        pos = 0
+        first = None
+        if self._fill:
+            pos = min(factor - self._fill, rows)
+            self._merge(mins[:pos], maxs[:pos], sums[:pos])
+            if self._fill == factor:
+                first = (self._min[None].copy(), self._max[None].copy(),
+                         self._sum[None].copy())
+                self._fill = 0
+        full = (rows - pos) // factor
+        end = pos + full * factor
+        shape = (full, factor, mins.shape[1])
+        result = (mins[pos:end].reshape(shape).min(axis=1),
+                  maxs[pos:end].reshape(shape).max(axis=1),
+                  sums[pos:end].reshape(shape).sum(axis=1,
+                                                   dtype=numpy.float64))
+        if end < rows:
+            self._fill = 0
+            self._merge(mins[end:], maxs[end:], sums[end:])
+        if first is not None:
+            result = tuple(numpy.concatenate(pair)
+                           for pair in zip(first, result))
+        return result
+
+    def _merge(self, mins, maxs, sums):
+        if not len(mins):
+            return
+        if self._fill:
+            numpy.minimum(self._min, mins.min(axis=0), out=self._min)
+            numpy.maximum(self._max, maxs.max(axis=0), out=self._max)
+            self._sum += sums.sum(axis=0, dtype=numpy.float64)
+        else:
+            self._min[:] = mins.min(axis=0)
+            self._max[:] = maxs.max(axis=0)
+            self._sum[:] = sums.sum(axis=0, dtype=numpy.float64)
+        self._fill += len(mins)
+
+
+class Decimator(object):
+    """
+    Streaming decimation of (scans, channels) blocks by averaging every
+    factor consecutive scans, with the partial average carried over
+    block boundaries.
+    """
+
+    def __init__(self, channels, factor):
+        """
+        :param channels: the number of channels per scan
+        :param factor: the number of scans per output scan
+        """
+        if factor < 1:
+            raise ValueError('factor must be at least 1')
+        self.factor = factor
+        self._reducer = _BucketReducer(channels, factor)
+
+    def feed(self, scans):
+        """
+        Decimate the next block of scans.
+        :param scans: (scans, channels) array, e.g. from ScanDemultiplexer
+        :returns: (scans // factor, channels) float64 array of averages
+        """
+        sums = self._reducer.feed(scans, scans, scans)[2]
+        return sums / self.factor
+
+
+Envelope = collections.namedtuple('Envelope', 'factor start min max mean')
+Envelope.__doc__ = """
+Min/max/mean envelope of a time window: bucket i covers the scans
+start + i * factor ... start + (i + 1) * factor - 1. min, max and mean
+are (buckets, channels) arrays.
+"""
+
+
+class EnvelopeReducer(object):
+    """
+    Multi-resolution min/max/mean envelopes of a scan stream for display.
+
+    Each zoom level reduces buckets of factors[i] scans, built
+    incrementally from the level below as blocks arrive. Every level
+    keeps the latest ``capacity`` buckets in a preallocated ring, so
+    memory and query cost are bounded regardless of the run length;
+    coarser levels reach further back in time.
+    """
+
+    def __init__(self, channels, factors=(16, 256, 4096, 65536),
+                 capacity=8192):
+        """
+        :param channels: the number of channels per scan
+        :param factors: scans per bucket of each level, increasing and
+        each a multiple of the previous one
+        (default = (16, 256, 4096, 65536))
+        :param capacity: buckets kept per level (default = 8192)
+        """
+        if list(factors) != sorted(set(factors)) or any(
+                high % low for low, high in zip(factors, factors[1:])):
+            raise ValueError('factors must increase and divide each other')
+        self.channels = channels
+        self.factors = tuple(factors)
+        self.capacity = capacity
+        self.scans = 0
+        ratios = [factors[0]] + [high // low for low, high in
+                                 zip(factors, factors[1:])]
+        self._reducers = [_BucketReducer(channels, ratio)
+                          for ratio in ratios]
+        self._store = [numpy.empty((3, capacity, channels))
+                       for _ in factors]
+        self._counts = [0] * len(factors)
+
+    def feed(self, scans):
+        """
+        Add the next block of scans to all levels.
+        :param scans: (scans, channels) array, e.g. from ScanDemultiplexer
+        """
+        mins = maxs = sums = scans
+        for level, reducer in enumerate(self._reducers):
+            mins, maxs, sums = reducer.feed(mins, maxs, sums)
+            if not len(mins):
+                break
+            self._append(level, mins, maxs, sums / self.factors[level])
+        self.scans += len(scans)
+
+    def _append(self, level, mins, maxs, means):
+        """Append buckets to the ring of a level."""
+        store = self._store[level]
+        count = len(mins)
+        if count > self.capacity:
+            skip = count - self.capacity
+            mins, maxs, means = mins[skip:], maxs[skip:], means[skip:]
+            self._counts[level] += skip
+            count = self.capacity
+        pos = self._counts[level] % self.capacity
+        first = min(count, self.capacity - pos)
+        for row, values in enumerate((mins, maxs, means)):
+            store[row, pos:pos + first] = values[:first]
+            store[row, :count - first] = values[first:]
+        self._counts[level] += count
+
+    def envelope(self, start=0, stop=None, max_points=2000):
+        """
+        Return the Envelope of the scans start ... stop - 1 at the finest
+        level with at most max_points buckets in the window. Buckets that
+        are no longer kept are left out, so the result may start later.
+        :param start: the index of the first scan of the window
+        :param stop: the index after the last scan of the window
+        (default = None, up to the latest complete bucket)
+        :param max_points: the maximum number of buckets (default = 2000)
+        """
+        if stop is None:
+            stop = self.scans
+        for level, factor in enumerate(self.factors):
+            first = start // factor
+            last = min(-(-stop // factor), self._counts[level])
+            kept = self._counts[level] - self.capacity
+            if last - first <= max_points and first >= kept:
+                break
+        first = max(first, kept, 0)
+        last = max(last, first)
+        # take at most max_points buckets, grouping them if necessary
+        group = max(-(-(last - first) // max_points), 1)
+        last = first + (last - first) // group * group
+        index = numpy.arange(first, last) % self.capacity
+        mins, maxs, means = self._store[level][:, index]
+        if group > 1:
+            shape = (len(index) // group, group, self.channels)
+            mins = mins.reshape(shape).min(axis=1)
+            maxs = maxs.reshape(shape).max(axis=1)
+            means = means.reshape(shape).mean(axis=1)
+        return Envelope(factor * group, first * factor, mins, maxs, means)
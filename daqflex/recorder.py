@@ -0,0 +1,241 @@
+# coding=utf-8
+"""
+Streaming recorder writing continuous transfer data to segment files.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import json
+import mmap
+import sys
+import time
+from threading import Thread, Event
+
+# size of the metadata header at the start of every segment file
+HEADER_SIZE = 4096
+MAGIC = b'DAQFLEX-RECORDING 1\n'
+
+
+def _encode_header(metadata):
+    """Serialize metadata into a fixed size, space padded header."""
+    header = MAGIC + json.dumps(metadata, sort_keys=True).encode('ascii')
+    if len(header) >= HEADER_SIZE:
+        raise ValueError('Recording metadata too large')
+    return header.ljust(HEADER_SIZE - 1) + b'\n'
+
+
+def read_header(path):
+    """
+    Return the metadata header of a segment file as a dict.
+    :param path: the segment file name
+    """
+    with open(path, 'rb') as seg:
+        header = seg.read(HEADER_SIZE)
+    if not header.startswith(MAGIC):
+        raise IOError('Not a DAQFlex recording: ' + path)
+    return json.loads(header[len(MAGIC):].decode('ascii'))
+
+
+def load_segment(path):
+    """
+    Return (metadata, samples) of a segment file, with the samples as a
+    read-only numpy memmap of uint16.
+    :param path: the segment file name
+    """
+    import numpy
+    metadata = read_header(path)
+    samples = numpy.memmap(path, dtype=numpy.uint16, mode='r',
+                           offset=HEADER_SIZE, shape=(metadata['samples'],))
+    return metadata, samples
+
+
+class Recorder(Thread):
+    """
+    Writer thread that follows a SampleRingBuffer with its own read
+    position and copies the data in large chunks into memory-mapped,
+    preallocated segment files. The polling thread is never blocked;
+    if the writer falls behind by more than the buffer capacity, the
+    overwritten samples are counted in ``lost`` and the next segment
+    starts after the gap. A segment also ends at every gap of the
+    stream indices, so sample i of a segment has the stream index
+    first_sample + i (as in DataBlock.sequence and get_transfer_gaps).
+    """
+
+    def __init__(self, path_pattern, metadata=None, segment_samples=1 << 24,
+                 segment_seconds=None, interval=0.1):
+        """
+        :param path_pattern: file name pattern with a placeholder for the
+        segment number, e.g. 'run_{0:04d}.daq'
+        :param metadata: dict of additional header entries
+        :param segment_samples: maximum number of samples per segment
+        (default = 2**24, 32 MiB)
+        :param segment_seconds: start a new segment after this many seconds
+        (default = None, rotate by size only)
+        :param interval: polling interval of the writer in seconds
+        (default = 0.1)
+        """
+        super(Recorder, self).__init__()
+        self.daemon = True
+        self.path_pattern = path_pattern
+        self.metadata = dict(metadata or {})
+        self.segment_samples = int(segment_samples)
+        self.segment_seconds = segment_seconds
+        self.interval = interval
+        self.shutdown = Event()
+        self.segments = []
+        self.samples_written = 0
+        self.lost = 0
+        self.write_time = 0.0
+        self.data_buffer = None
+        self._position = 0
+        self._file = None
+        self._map = None
+        self._seg_index = 0
+        self._seg_samples = 0
+        self._seg_start = None
+        self._seg_first = 0
+
+    def attach(self, data_buf, metadata=None):
+        """
+        Follow a buffer starting at its current write position.
+        :param data_buf: the SampleRingBuffer to record
+        :param metadata: dict of header entries provided by the device
+        (entries given to the constructor take precedence)
+        """
+        self.data_buffer = data_buf
+        self._position = data_buf.head
+        if metadata:
+            merged = dict(metadata)
+            merged.update(self.metadata)
+            self.metadata = merged
+
+    @property
+    def bytes_written(self):
+        """Number of sample bytes written to disk."""
+        return self.samples_written * 2
+
+    @property
+    def bandwidth(self):
+        """Write bandwidth in bytes per second spent writing."""
+        if not self.write_time:
+            return None
+        return self.bytes_written / self.write_time
+
+    def stop(self):
+        """Write all remaining data, close the segment and end the thread."""
+        self.shutdown.set()
+        self.join()
+
+    def run(self):
+        try:
+            while not self.shutdown.wait(self.interval):
+                self._write_available()
+            self._write_available()
+        finally:
+            self._close_segment()
+
+    def _write_available(self):
+        """Copy all new samples from the buffer to the segment files."""
+        buf = self.data_buffer
+        if not buf.is_valid(self._position):
+            # the writer was overtaken by the polling thread
+            skip = buf.oldest - self._position
+            self.lost += skip
+            self._position += skip
+            self._close_segment()
+        available = buf.head - self._position
+        while available > 0:
+            sequence = buf.stream_index(self._position)
+            if self._map is None or self._rotation_due() or \
+                    sequence != self._seg_first + self._seg_samples:
+                self._open_segment(sequence)
+            count = min(available, self.segment_samples - self._seg_samples)
+            gap = buf.next_gap(self._position)
+            if gap is not None:
+                count = min(count, gap - self._position)
+            t_start = time.time()
+            offset = HEADER_SIZE + self._seg_samples * 2
+            for view in buf.views(self._position, count):
+                data = view.cast('B')
+                self._map[offset:offset + len(data)] = data
+                offset += len(data)
+            self.write_time += time.time() - t_start
+            if not buf.is_valid(self._position):
+                # overwritten while copying, retry with the next call
+                return
+            self._position += count
+            self._seg_samples += count
+            self.samples_written += count
+            available -= count
+
+    def _rotation_due(self):
+        """Check whether the current segment is full or too old."""
+        if self._seg_samples >= self.segment_samples:
+            return True
+        return (self.segment_seconds is not None and
+                time.time() - self._seg_start >= self.segment_seconds)
+
+    def _open_segment(self, sequence):
+        """
+        Close the current segment and preallocate a new one.
+        :param sequence: the stream index of the first sample
+        """
+        self._close_segment()
+        path = self.path_pattern.format(len(self.segments))
+        self._seg_index = len(self.segments)
+        self._seg_start = time.time()
+        self._seg_samples = 0
+        self._seg_first = sequence
+        self._file = open(path, 'w+b')
+        self._file.truncate(HEADER_SIZE + self.segment_samples * 2)
+        self._map = mmap.mmap(self._file.fileno(),
+                              HEADER_SIZE + self.segment_samples * 2)
+        self._map[:HEADER_SIZE] = _encode_header(self._header())
+        self.segments.append(path)
+
+    def _close_segment(self):
+        """Finalize the header and trim the current segment file."""
+        if self._map is None:
+            return
+        self._map[:HEADER_SIZE] = _encode_header(self._header())
+        self._map.flush()
+        self._map.close()
+        self._map = None
+        self._file.truncate(HEADER_SIZE + self._seg_samples * 2)
+        self._file.close()
+        self._file = None
+
+    def _header(self):
+        """Return the metadata header of the current segment."""
+        header = dict(self.metadata)
+        header.update({
+            'segment': self._seg_index,
+            'first_sample': self._seg_first,
+            'samples': self._seg_samples,
+            'start_time': self._seg_start,
+            'byteorder': sys.byteorder,
+            'dtype': 'uint16',
+        })
+        return header
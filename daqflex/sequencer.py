@@ -0,0 +1,189 @@
+# coding=utf-8
+"""
+Deadline-scheduled execution of timed DIO edges with jitter statistics.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import time
+from array import array
+from collections import namedtuple
+from threading import Thread, Event
+
+SequencerStats = namedtuple('SequencerStats', [
+    'edges',          # number of executed edges
+    'late',           # edges completed later than late_limit after deadline
+    'latency_mean',   # mean delay from the deadline to the completed command
+    'jitter',         # standard deviation of that delay in s
+    'latency_p99',    # 99th percentile of that delay in s
+    'latency_max',    # largest delay in s
+    'duration_mean',  # mean round trip time of a command in s
+    'duration_max',   # largest round trip time of a command in s
+    'max_rate',       # edges per second with 99 % completed before the next
+    'issue_mean',     # mean delay from the deadline to sending the command
+    'issue_max',      # largest of these delays in s
+])
+
+
+class DIOSequencer(Thread):
+    """
+    Thread executing a timed list of DIO edges (or other short commands).
+    The command payloads are encoded up front and every edge is issued
+    against an absolute perf_counter deadline: the thread sleeps until
+    spin seconds before the deadline and busy-waits for the rest, so
+    errors do not accumulate over the sequence.
+    The delay of each command after its deadline is recorded up to the
+    completed control transfer, after which the device has set the edge;
+    stats() summarizes it to show the achievable software-timed rate.
+    Besides the USB round trip, the main sources of jitter are the OS
+    scheduler and the GIL: a busy Python thread can hold it for up to
+    sys.getswitchinterval() seconds.
+    """
+
+    def __init__(self, device, edges, channel='0/0', spin=0.002,
+                 late_limit=0.001, start_delay=0.01):
+        """
+        :param device: the device to send the commands to
+        :param edges: sequence of (time, value) with the time in seconds
+        from the start of the sequence in ascending order. An integer value
+        is written to the DIO channel, a string is sent as a command.
+        :param channel: the DIO port or bit for integer values, e.g. '0/0'
+        for bit 0 of port 0 (default = '0/0')
+        :param spin: time before each deadline spent busy-waiting in s
+        (default = 0.002)
+        :param late_limit: delay in s after which an edge counts as late
+        (default = 0.001)
+        :param start_delay: time between start() and the first deadline in
+        s, unless a start time is given (default = 0.01)
+        """
+        super(DIOSequencer, self).__init__()
+        self.daemon = True
+        self.device = device
+        self.spin = spin
+        self.late_limit = late_limit
+        self.start_delay = start_delay
+        self.offsets = array('d')
+        self.payloads = []
+        for t, value in edges:
+            if self.offsets and t < self.offsets[-1]:
+                raise ValueError('Edge times must be ascending')
+            if not isinstance(value, str):
+                value = 'DIO{{{0}}}:VALUE={1:d}'.format(channel, value)
+            self.offsets.append(t)
+            self.payloads.append(device.encode_message(value))
+        count = len(self.payloads)
+        self.deadlines = array('d', [0.0]) * count
+        self.issued = array('d', [0.0]) * count
+        self.completed = array('d', [0.0]) * count
+        self.executed = 0
+        self.t_start = None
+        self.error = None
+        self.shutdown = Event()
+
+    def start(self, t_start=None):
+        """
+        Start executing the sequence.
+        :param t_start: the perf_counter time of the sequence start
+        (default = None, start_delay seconds from now)
+        """
+        if t_start is None:
+            t_start = time.perf_counter() + self.start_delay
+        self.t_start = t_start
+        for i, offset in enumerate(self.offsets):
+            self.deadlines[i] = t_start + offset
+        super(DIOSequencer, self).start()
+
+    def stop(self):
+        """Skip the remaining edges and wait for the thread to end."""
+        self.shutdown.set()
+        self.join()
+
+    def run(self):
+        clock = time.perf_counter
+        send = self.device.send_encoded
+        wait = self.shutdown.wait
+        spin = self.spin
+        deadlines, issued, completed = \
+            self.deadlines, self.issued, self.completed
+        try:
+            for i, payload in enumerate(self.payloads):
+                deadline = deadlines[i]
+                remaining = deadline - clock()
+                if remaining > spin and wait(remaining - spin):
+                    break
+                if self.shutdown.is_set():
+                    break
+                now = clock()
+                while now < deadline:
+                    now = clock()
+                issued[i] = now
+                send(payload)
+                completed[i] = clock()
+                self.executed = i + 1
+        except IOError as err:
+            self.error = err
+
+    def latencies(self):
+        """
+        Return the delays of the executed edges after their deadlines,
+        up to the completion of the command.
+        """
+        return [self.completed[i] - self.deadlines[i]
+                for i in range(self.executed)]
+
+    def issue_latencies(self):
+        """
+        Return the delays from the deadlines to sending the commands of
+        the executed edges, i.e. the timing error of the thread alone.
+        """
+        return [self.issued[i] - self.deadlines[i]
+                for i in range(self.executed)]
+
+    def stats(self):
+        """
+        Return the SequencerStats of the executed edges, or None if no
+        edge was executed yet.
+        """
+        count = self.executed
+        if not count:
+            return None
+        latencies = sorted(self.latencies())
+        issue = self.issue_latencies()
+        durations = [self.completed[i] - self.issued[i] for i in range(count)]
+        mean = sum(latencies) / count
+        jitter = (sum((x - mean) ** 2 for x in latencies) / count) ** 0.5
+        p99 = latencies[min(int(0.99 * count), count - 1)]
+        return SequencerStats(
+            edges=count,
+            late=sum(1 for x in latencies if x > self.late_limit),
+            latency_mean=mean,
+            jitter=jitter,
+            latency_p99=p99,
+            latency_max=latencies[-1],
+            duration_mean=sum(durations) / count,
+            duration_max=max(durations),
+            max_rate=1.0 / p99 if p99 > 0 else None,
+            issue_mean=sum(issue) / count,
+            issue_max=max(issue))
@@ -0,0 +1,698 @@
+# coding=utf-8
+"""
+Software stand-in for DAQFlex USB devices.
+
+The simulator emulates the parts of a PyUSB device used by MCCDevice:
+configuration and endpoint descriptors, DAQFlex control transfers
+(including AISCAN configuration, calibration queries and FPGA upload),
+bulk IN data generated in real time at the configured scan rate and an
+output scan FIFO drained at the AOSCAN rate.
+It allows tests and benchmarks to run without hardware::
+
+    dev = open_simulated(daqflex.USB_1608G, signal=counter_signal)
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import array
+import collections
+import errno
+import os
+import re
+import time
+from threading import Thread, Condition, Lock
+import numpy
+from .utils import usb
+from .transfer import TRANSFER_COMPLETED, TRANSFER_TIMED_OUT, \
+    TRANSFER_CANCELLED
+
+# voltage limits of the DAQFlex range names
+RANGES = {
+    'BIP20V': (-20.0, 20.0),
+    'BIP10V': (-10.0, 10.0),
+    'BIP5V': (-5.0, 5.0),
+    'BIP2V': (-2.0, 2.0),
+    'BIP1V': (-1.0, 1.0),
+    'UNI10V': (0.0, 10.0),
+    'UNI5V': (0.0, 5.0),
+}
+
+_CHANNEL_RE = re.compile(r'^(AI|AO|DIO)\{(\d+)(?:/(\d+))?\}:(\w+)$')
+
+
+def counter_signal(sim, index):
+    """Signal generator returning the sample index modulo 2**16."""
+    return (index & 0xFFFF).astype(numpy.uint16)
+
+
+def dio_loopback_signal(sim, index):
+    """
+    Signal generator emulating DIO0 wired to analog input CH0 (as in the
+    hardware test setup): CH0 reads 5 V while DIO0 is high, all other
+    channels read 0 V.
+    """
+    times = sim.sample_times(index)
+    volts = numpy.zeros(len(index))
+    chans = sim.sample_channels(index)
+    on_ch0 = chans == 0
+    volts[on_ch0] = sim.dio_levels(times[on_ch0]) * 5.0
+    return sim.volts_to_counts(volts, chans)
+
+
+class SimulatedEndpoint(object):
+    """Bulk endpoint descriptor and data path of a simulated device."""
+    bDescriptorType = 5
+    bmAttributes = 2
+
+    def __init__(self, sim, address, max_packet_size):
+        self.device = sim
+        self.bEndpointAddress = address
+        self.wMaxPacketSize = max_packet_size
+        self.transfer_queue = SimulatedTransferQueue
+
+    def read(self, size_or_buffer, timeout=None):
+        """PyUSB compatible read: returns an array or the byte count."""
+        if isinstance(size_or_buffer, array.array):
+            view = memoryview(size_or_buffer).cast('B')
+            return self.device.bulk_read(view, timeout)
+        buf = array.array('B', [0]) * size_or_buffer
+        count = self.device.bulk_read(memoryview(buf), timeout)
+        del buf[count:]
+        return buf
+
+    def readinto(self, view, timeout):
+        """Read into a writable byte memoryview, return the byte count."""
+        return self.device.bulk_read(view, timeout)
+
+    def write(self, data, timeout=None):
+        """Accept data on a bulk OUT endpoint."""
+        return self.device.bulk_write(data, timeout)
+
+    def clear_halt(self):
+        self.device.clear_halt(self.bEndpointAddress)
+
+
+class _SimulatedInterface(object):
+    bInterfaceNumber = 0
+    bAlternateSetting = 0
+
+    def __init__(self, endpoints):
+        self._endpoints = endpoints
+
+    def __iter__(self):
+        return iter(self._endpoints)
+
+
+class _SimulatedConfiguration(object):
+    def __init__(self, interface):
+        self._interface = interface
+
+    def __getitem__(self, index):
+        return self._interface
+
+    def __iter__(self):
+        return iter([self._interface])
+
+
+class SimulatedDevice(object):
+    """
+    Stand-in for a PyUSB device of a DAQFlex model.
+
+    The analog input scan produces samples in real time at the configured
+    rate. While a bulk read is pending, samples are transferred directly;
+    otherwise they accumulate in a FIFO of fifo_size samples. A FIFO
+    overflow stops the scan with status OVERRUN, or, with
+    stop_on_overrun=False, drops the newest samples and continues.
+    """
+
+    def __init__(self, device_class, serial_number='SIM00001',
+                 signal=counter_signal, channels=8, fifo_size=4096,
+                 max_packet_size=512, ctrl_latency=0.0, read_latency=0.0,
+                 stop_on_overrun=True, fpga_chunk_size=1024,
+                 fpga_oversized='stall', fpga_config_delay=0.02,
+                 ao_fifo_size=4096, clock_drift=0.0, firmware_version='1.00'):
+        """
+        :param device_class: the MCCDevice subclass to simulate
+        :param serial_number: the reported serial number
+        :param signal: generator function(sim, index) -> uint16 counts
+        :param channels: number of analog input channels
+        :param fifo_size: device FIFO size in samples
+        :param max_packet_size: bulk endpoint packet size in bytes
+        :param ctrl_latency: duration of a control transfer in seconds
+        :param read_latency: fixed duration of a bulk read in seconds
+        :param stop_on_overrun: stop the scan on a FIFO overflow
+        :param fpga_chunk_size: largest FPGA upload transfer accepted
+        :param fpga_oversized: handling of larger FPGA upload transfers,
+        'stall' rejects them, 'ignore' accepts them but keeps only
+        fpga_chunk_size bytes, so the FPGA does not configure
+        :param fpga_config_delay: time until the FPGA is configured
+        :param ao_fifo_size: output scan FIFO size in samples
+        :param clock_drift: relative deviation of the scan clock from the
+        configured rate, e.g. 1e-4 for a clock running 100 ppm fast
+        :param firmware_version: the reported firmware version
+        """
+        self.device_class = device_class
+        self.idVendor = device_class.id_vendor
+        self.idProduct = device_class.id_product
+        self.serial_number = serial_number
+        self.signal = signal
+        self.channels = channels
+        self.fifo_size = fifo_size
+        self.max_counts = device_class.max_counts
+        self.ctrl_latency = ctrl_latency
+        self.read_latency = read_latency
+        self.stop_on_overrun = stop_on_overrun
+        self.fpga_chunk_size = fpga_chunk_size
+        self.fpga_oversized = fpga_oversized
+        self.fpga_config_delay = fpga_config_delay
+        self.clock_drift = clock_drift
+        self.firmware_version = firmware_version
+        self.ep_in = SimulatedEndpoint(self, 0x81, max_packet_size)
+        self.ep_out = SimulatedEndpoint(self, 0x02, max_packet_size)
+        self._config = _SimulatedConfiguration(
+            _SimulatedInterface([self.ep_in, self.ep_out]))
+        self.ctrl_transfers = 0
+        self.bulk_reads = 0
+        # CPU time spent generating samples, excluded by benchmarks
+        self.signal_time = 0.0
+        self.lost = 0
+        self.clear_halts = 0
+        self._read_error = None
+        self._halted = False
+        self.output = []
+        self.ao_fifo_size = ao_fifo_size
+        self.output_scan = {'LOWCHAN': 0, 'HIGHCHAN': 0, 'SAMPLES': 0,
+                            'RATE': 1000.0}
+        self._ao_status = 'IDLE'
+        self._ao_t_start = None
+        self._ao_written = 0
+        self._ao_consumed = 0
+        self._lock = Lock()
+        self._response = ''
+        self._fpga = 'CONFIGMODE' if device_class.fpga_image else \
+            'CONFIGURED'
+        self._fpga_loaded = None
+        self._fpga_corrupt = False
+        self.chmode = 'SE'
+        self.ranges = dict((chan, 'BIP10V') for chan in range(channels))
+        self.calibration = dict((chan, (1.0, 0.0))
+                                for chan in range(channels))
+        self.scan = {'LOWCHAN': 0, 'HIGHCHAN': 0, 'SAMPLES': 0,
+                     'RATE': 1000.0, 'XFRMODE': 'BLOCKIO'}
+        self._dio = [(0.0, 0)]
+        self._dio_dir = 'IN'
+        self._running = False
+        self._status = 'IDLE'
+        self._t_start = None
+        self._next = 0
+        self._stop_index = 0
+        self._reading = 0
+        self._skips = collections.deque()
+
+    # descriptor interface used by MCCDevice
+
+    def set_configuration(self):
+        pass
+
+    def get_active_configuration(self):
+        return self._config
+
+    def __iter__(self):
+        return iter([self._config])
+
+    # control transfers
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0,
+                      data_or_wLength=None, timeout=None):
+        """Handle a control transfer like usb.core.Device.ctrl_transfer."""
+        self.ctrl_transfers += 1
+        if self.ctrl_latency:
+            time.sleep(self.ctrl_latency)
+        if bRequest == 0x0A:
+            # standard GET_INTERFACE request
+            return array.array('B', [0])
+        if bRequest == 0x51:
+            return self._fpga_data(data_or_wLength)
+        if bmRequestType & 0x80:
+            ret = array.array('B', (self._response + '\0').encode('ascii'))
+            return ret[:data_or_wLength]
+        message = bytes(bytearray(data_or_wLength)).decode('ascii')
+        with self._lock:
+            self._response = self.handle_message(message.rstrip('\0'))
+        return len(data_or_wLength)
+
+    def _fpga_data(self, data):
+        if self._fpga != 'UNLOCKED':
+            raise usb.core.USBError('Pipe error', errno=errno.EPIPE)
+        if len(data) > self.fpga_chunk_size:
+            if self.fpga_oversized == 'stall':
+                raise usb.core.USBError('Pipe error', errno=errno.EPIPE)
+            self._fpga_corrupt = True
+        self._fpga_loaded = time.time()
+        return len(data)
+
+    def handle_message(self, message):
+        """Return the response to a DAQFlex command string."""
+        query = message.startswith('?')
+        name, _, value = message.lstrip('?').partition('=')
+        match = _CHANNEL_RE.match(name)
+        if match:
+            kind, chan, bit, prop = match.groups()
+            result = self._channel_property(kind, int(chan), prop, value,
+                                            query)
+        elif name == 'AI':
+            # differential inputs use two channels each
+            result = str(self.channels if self.chmode == 'SE'
+                         else self.channels // 2)
+        elif name.startswith('AISCAN:'):
+            result = self._scan_property(name[7:], value, query)
+        elif name.startswith('AOSCAN:'):
+            result = self._output_property(name[7:], value, query)
+        elif name == 'AI:RANGE' and not query:
+            self.ranges = dict((chan, value) for chan in self.ranges)
+            result = None
+        elif name == 'AI:CHMODE':
+            if not query:
+                self.chmode = value
+            result = self.chmode
+        elif name == 'DEV:MFGSER':
+            result = self.serial_number
+        elif name == 'DEV:FWV':
+            result = self.firmware_version
+        elif name == 'DEV:FPGACFG':
+            result = self._fpga_config(value, query)
+        else:
+            result = value if not query else '0'
+        if query:
+            return '{0}={1}'.format(name, result)
+        return name
+
+    def _channel_property(self, kind, chan, prop, value, query):
+        if kind == 'AI' and prop == 'RANGE':
+            if not query:
+                self.ranges[chan] = value
+            return self.ranges[chan]
+        if kind == 'AI' and prop in ('SLOPE', 'OFFSET'):
+            slope, offset = self.calibration[chan]
+            return '{0:.6f}'.format(slope if prop == 'SLOPE' else offset)
+        if kind == 'DIO' and prop == 'DIR':
+            if not query:
+                self._dio_dir = value
+            return self._dio_dir
+        if kind == 'DIO' and prop == 'VALUE':
+            if not query:
+                self._dio.append((time.time(), int(value)))
+            return str(self._dio[-1][1])
+        return value or '0'
+
+    def _scan_property(self, prop, value, query):
+        if prop == 'START':
+            self._start_scan()
+        elif prop == 'STOP':
+            self._running = False
+            if self._status == 'RUNNING':
+                self._status = 'IDLE'
+        elif prop == 'STATUS':
+            self._update_scan(time.time(), not self._reading)
+            return self._status
+        elif query:
+            return self.scan.get(prop, '0')
+        elif prop in ('LOWCHAN', 'HIGHCHAN', 'SAMPLES'):
+            self.scan[prop] = int(value)
+        elif prop == 'RATE':
+            self.scan[prop] = float(value)
+        else:
+            self.scan[prop] = value
+        return None
+
+    def _fpga_config(self, value, query):
+        if not query:
+            if value == '0XAD' and self._fpga != 'CONFIGURED':
+                # a new unlock restarts the upload
+                self._fpga = 'UNLOCKED'
+                self._fpga_loaded = None
+                self._fpga_corrupt = False
+            return None
+        if self._fpga == 'UNLOCKED' and self._fpga_loaded and \
+                not self._fpga_corrupt and \
+                time.time() > self._fpga_loaded + self.fpga_config_delay:
+            self._fpga = 'CONFIGURED'
+        return 'CONFIGURED' if self._fpga == 'CONFIGURED' else 'CONFIGMODE'
+
+    def _output_property(self, prop, value, query):
+        if prop == 'START':
+            self._ao_t_start = time.time()
+            self._ao_status = 'RUNNING'
+        elif prop == 'STOP':
+            if self._ao_status == 'RUNNING':
+                self._ao_status = 'IDLE'
+            # the FIFO is flushed
+            self._ao_written = 0
+            self._ao_consumed = 0
+        elif prop == 'STATUS':
+            self._update_output(time.time())
+            return self._ao_status
+        elif query:
+            return self.output_scan.get(prop, '0')
+        elif prop in ('LOWCHAN', 'HIGHCHAN', 'SAMPLES'):
+            self.output_scan[prop] = int(value)
+        elif prop == 'RATE':
+            self.output_scan[prop] = float(value)
+        else:
+            self.output_scan[prop] = value
+        return None
+
+    # analog output scan
+
+    def _output_consumed(self, now):
+        """Number of samples the output scan has taken from the FIFO."""
+        if self._ao_status != 'RUNNING':
+            return self._ao_consumed
+        scan = self.output_scan
+        chans = scan['HIGHCHAN'] - scan['LOWCHAN'] + 1
+        count = int((now - self._ao_t_start) * scan['RATE']) * chans
+        if scan['SAMPLES']:
+            count = min(count, scan['SAMPLES'] * chans)
+        return count
+
+    def _update_output(self, now):
+        """Detect FIFO underruns and the end of a finite output scan."""
+        if self._ao_status != 'RUNNING':
+            return
+        consumed = self._output_consumed(now)
+        scan = self.output_scan
+        chans = scan['HIGHCHAN'] - scan['LOWCHAN'] + 1
+        if consumed > self._ao_written:
+            self._ao_consumed = self._ao_written
+            self._ao_status = 'UNDERRUN'
+        elif scan['SAMPLES'] and consumed >= scan['SAMPLES'] * chans:
+            self._ao_consumed = consumed
+            self._ao_status = 'IDLE'
+        else:
+            self._ao_consumed = consumed
+
+    def bulk_write(self, data, timeout):
+        """
+        Accept output scan data into the output FIFO, blocking while it
+        is full. A stopped scan (after an underrun) stalls the endpoint.
+        """
+        data = bytes(bytearray(data))
+        need = len(data) // 2
+        deadline = time.time() + (timeout or 1000) / 1e3
+        pos = 0
+        while pos < need:
+            now = time.time()
+            with self._lock:
+                self._update_output(now)
+                if self._ao_status == 'UNDERRUN':
+                    raise usb.core.USBError('Pipe error', errno=errno.EPIPE)
+                level = self._ao_written - self._output_consumed(now)
+                count = min(self.ao_fifo_size - level, need - pos)
+                if count > 0:
+                    self.output.append(data[pos * 2:(pos + count) * 2])
+                    self._ao_written += count
+                    pos += count
+                    continue
+            if now >= deadline:
+                break
+            time.sleep(0.001)
+        if pos == 0:
+            raise usb.core.USBError('Operation timed out',
+                                    errno=errno.ETIMEDOUT)
+        return pos * 2
+
+    # analog input scan
+
+    @property
+    def scan_channels(self):
+        """Number of channels per scan."""
+        return self.scan['HIGHCHAN'] - self.scan['LOWCHAN'] + 1
+
+    @property
+    def scan_rate(self):
+        """Actual scan rate of the device clock in Hz."""
+        return self.scan['RATE'] * (1.0 + self.clock_drift)
+
+    def sample_times(self, index):
+        """Acquisition times of absolute sample indices."""
+        return self._t_start + (index // self.scan_channels) / \
+            self.scan_rate
+
+    def sample_channels(self, index):
+        """Analog input channels of absolute sample indices."""
+        return self.scan['LOWCHAN'] + index % self.scan_channels
+
+    def dio_levels(self, times):
+        """DIO0 output levels at the given times."""
+        changes = numpy.array([t for t, _ in self._dio])
+        values = numpy.array([v for _, v in self._dio])
+        return values[numpy.searchsorted(changes, times, side='right') - 1]
+
+    def volts_to_counts(self, volts, chans):
+        """Convert voltages to raw counts using the channel ranges."""
+        lows = numpy.array([RANGES[self.ranges[c]][0] for c in chans])
+        highs = numpy.array([RANGES[self.ranges[c]][1] for c in chans])
+        counts = (volts - lows) / (highs - lows) * self.max_counts
+        return numpy.clip(numpy.round(counts), 0,
+                          self.max_counts).astype(numpy.uint16)
+
+    def _start_scan(self):
+        self._t_start = time.time()
+        self._running = True
+        self._status = 'RUNNING'
+        self._next = 0
+        self._skips.clear()
+
+    def _produced(self, now):
+        """Number of samples acquired by the scan up to time now."""
+        if self._t_start is None:
+            return 0
+        count = int((now - self._t_start) * self.scan_rate) * \
+            self.scan_channels
+        total = self.scan['SAMPLES'] * self.scan_channels
+        if total:
+            count = min(count, total)
+        return count
+
+    def _update_scan(self, now, overflow=True):
+        """
+        Apply FIFO overflow and end-of-scan conditions up to now. While
+        a bulk read is pending, samples flow to the host and cannot
+        overflow the FIFO.
+        """
+        if not self._running:
+            return
+        skipped = sum(end - start for start, end in self._skips)
+        level = self._produced(now) - self._next - skipped
+        if overflow and level > self.fifo_size:
+            overflow = level - self.fifo_size
+            self.lost += overflow
+            end = self._produced(now)
+            if self.stop_on_overrun:
+                self._running = False
+                self._status = 'OVERRUN'
+                self._stop_index = end - overflow
+            else:
+                self._skips.append((end - overflow, end))
+        total = self.scan['SAMPLES'] * self.scan_channels
+        if total and self._produced(now) >= total:
+            self._running = False
+            self._status = 'IDLE'
+
+    def _available(self, now):
+        """Return the absolute sample indices that can be sent now."""
+        with self._lock:
+            self._update_scan(now, overflow=False)
+            if self._t_start is None:
+                return self._next, 0
+            end = self._produced(now)
+            if self._status == 'OVERRUN':
+                end = min(end, self._stop_index)
+            elif not self._running and self._status == 'IDLE' and \
+                    not self.scan['SAMPLES']:
+                end = self._next
+            while self._skips and self._next >= self._skips[0][0]:
+                self._next = max(self._next, self._skips.popleft()[1])
+            if self._skips:
+                end = min(end, self._skips[0][0])
+            return self._next, max(end - self._next, 0)
+
+    def inject_read_error(self, error_number):
+        """
+        Make the next bulk read fail with a USBError. EPIPE stalls the
+        endpoint until clear_halt() is called.
+        :param error_number: the errno of the error, e.g. errno.EIO
+        """
+        self._read_error = error_number
+
+    def clear_halt(self, address):
+        """Clear a stall of an endpoint."""
+        self.clear_halts += 1
+        if address == self.ep_in.bEndpointAddress:
+            self._halted = False
+
+    def bulk_read(self, view, timeout):
+        """
+        Fill a byte memoryview with scan data, blocking until it is full
+        or the scan has ended. As with libusb, a read still incomplete
+        after the timeout (in ms) raises ETIMEDOUT, and the data it has
+        received is lost.
+        """
+        self.bulk_reads += 1
+        error_number, self._read_error = self._read_error, None
+        if error_number == errno.EPIPE:
+            self._halted = True
+        if self._halted:
+            raise usb.core.USBError('Pipe error', errno=errno.EPIPE)
+        if error_number is not None:
+            raise usb.core.USBError(os.strerror(error_number),
+                                    errno=error_number)
+        t_start = time.time()
+        with self._lock:
+            self._update_scan(t_start)
+            self._reading += 1
+        try:
+            return self._bulk_read(view, timeout, t_start)
+        finally:
+            with self._lock:
+                self._reading -= 1
+
+    def _bulk_read(self, view, timeout, t_start):
+        if self.read_latency:
+            time.sleep(self.read_latency)
+        deadline = t_start + (timeout or 1000) / 1e3
+        need = len(view) // 2
+        packet = min(self.ep_in.wMaxPacketSize // 2, need)
+        pos = 0
+        out = numpy.frombuffer(view, dtype=numpy.uint16)
+        while pos < need:
+            now = time.time()
+            start, count = self._available(now)
+            finished = not self._running
+            count = min(count, need - pos)
+            if not finished and count < need - pos:
+                # the device sends full packets while the scan is running
+                count -= count % packet
+            if count:
+                cpu = time.thread_time()
+                index = numpy.arange(start, start + count, dtype=numpy.int64)
+                out[pos:pos + count] = self.signal(self, index)
+                self.signal_time += time.thread_time() - cpu
+                pos += count
+                with self._lock:
+                    self._next = start + count
+                if count % packet:
+                    break
+                continue
+            if finished and pos:
+                # a short packet ends the transfer at the end of the scan
+                break
+            if now >= deadline:
+                raise usb.core.USBError('Operation timed out',
+                                        errno=errno.ETIMEDOUT)
+            wait = (need - pos) / (self.scan_rate * self.scan_channels)
+            time.sleep(max(min(wait, deadline - now, 0.01), 1e-4))
+        return pos * 2
+
+
+class SimulatedTransferQueue(object):
+    """
+    Asynchronous transfer queue for simulated endpoints, servicing the
+    queued transfers back to back on a host controller thread.
+    """
+
+    def __init__(self, endpoint, callback):
+        self._endpoint = endpoint
+        self._callback = callback
+        self._submitted = collections.deque()
+        self._completed = collections.deque()
+        self._cond = Condition()
+        self._cancelled = False
+        self.pending = 0
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, slot, buf, timeout):
+        with self._cond:
+            self._submitted.append((slot, buf, timeout))
+            self.pending += 1
+            self._cond.notify_all()
+
+    def poll(self, timeout):
+        with self._cond:
+            if not self._completed:
+                self._cond.wait(timeout)
+            done = list(self._completed)
+            self._completed.clear()
+        for slot, status, length in done:
+            self.pending -= 1
+            self._callback(slot, status, length)
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    def close(self):
+        self.cancel()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._submitted and not self._cancelled:
+                    self._cond.wait()
+                if self._cancelled:
+                    for slot, _, _ in self._submitted:
+                        self._completed.append((slot, TRANSFER_CANCELLED, 0))
+                    self._submitted.clear()
+                    self._cond.notify_all()
+                    return
+                slot, buf, timeout = self._submitted[0]
+            try:
+                length = self._endpoint.read(buf, timeout)
+            except usb.core.USBError:
+                length = 0
+            status = TRANSFER_COMPLETED if length == len(buf) * 2 \
+                else TRANSFER_TIMED_OUT
+            with self._cond:
+                self._submitted.popleft()
+                self._completed.append((slot, status, length))
+                self._cond.notify_all()
+
+
+def open_simulated(device_class, **options):
+    """
+    Return a device_class instance connected to a SimulatedDevice.
+    :param device_class: the MCCDevice subclass to simulate
+    Keyword arguments are passed to SimulatedDevice, except for
+    cache_responses and device_cache which are passed to the device
+    constructor.
+    """
+    cache = options.pop('cache_responses', False)
+    device_cache = options.pop('device_cache', None)
+    sim = SimulatedDevice(device_class, **options)
+    return device_class(usb_device=sim, cache_responses=cache,
+                        device_cache=device_cache)
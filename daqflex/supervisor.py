@@ -0,0 +1,181 @@
+# coding=utf-8
+"""
+Supervised continuous transfers resuming after USB errors.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import collections
+import errno
+import math
+import time
+from .utils import usb
+
+# kinds of acquisition errors
+TRANSIENT = 'transient'  # e.g. a corrupted transfer, restart the scan
+STALL = 'stall'          # halted endpoint, clear it and restart the scan
+OVERRUN = 'overrun'      # device FIFO overflow, restart the scan
+FATAL = 'fatal'          # e.g. the device was disconnected
+
+_FATAL_ERRNOS = frozenset([errno.ENODEV, errno.ENOENT, errno.ENXIO,
+                           errno.EACCES, errno.ESHUTDOWN])
+
+Recovery = collections.namedtuple('Recovery', [
+    'time',      # time.time() of the error
+    'kind',      # the error kind, e.g. STALL
+    'error',     # description of the error
+    'gap',       # (start, end) stream indices of the lost samples
+    'duration',  # time from the error until the scan was restarted
+])
+
+
+def classify_error(err):
+    """
+    Return the kind of a bulk read error: STALL, FATAL or TRANSIENT.
+    :param err: the USBError (or IOError)
+    """
+    if err.errno == errno.EPIPE:
+        return STALL
+    if err.errno in _FATAL_ERRNOS:
+        return FATAL
+    return TRANSIENT
+
+
+class StreamSupervisor(object):
+    """
+    Keeps a continuous transfer running through USB errors and device
+    FIFO overruns.
+
+    Pass it to MCCDevice.start_continuous_transfer. When a read fails
+    (or times out while the scan reports OVERRUN), the supervisor stops
+    the scan, clears a stalled endpoint, discards stale data and starts
+    the scan again with the AISCAN settings the device has sent,
+    without reconnecting the device or reloading the FPGA. Streaming
+    continues into the same buffer. The samples the device clock would
+    have acquired in the meantime are skipped in the stream index and
+    listed as a gap, so stream indices and timestamps stay on the time
+    base of the scan.
+
+    Fatal errors (e.g. a disconnected device), errors of finite scans
+    (AISCAN:SAMPLES other than 0), failed recoveries or more than
+    max_recoveries within window seconds end the transfer; the buffer
+    then raises the error after the buffered data.
+    """
+
+    def __init__(self, max_recoveries=5, window=60.0):
+        """
+        :param max_recoveries: the number of recoveries allowed within
+        window seconds (default = 5)
+        :param window: the period in seconds (default = 60.0)
+        """
+        self.max_recoveries = max_recoveries
+        self.window = window
+        self.recoveries = []
+        self.error = None
+        self._device = None
+        self._thread = None
+
+    @property
+    def recovery_time(self):
+        """Total time in seconds spent on recoveries."""
+        return sum(recovery.duration for recovery in self.recoveries)
+
+    def attach(self, device, thread):
+        """
+        Supervise a continuous transfer, called by
+        MCCDevice.start_continuous_transfer.
+        :param device: the MCCDevice
+        :param thread: the PollingThread of the transfer
+        """
+        self._device = device
+        self._thread = thread
+        self.error = None
+        thread.supervisor = self
+
+    def handle_error(self, err):
+        """
+        Recover from a failed read. Returns True if the scan is running
+        again, False if the transfer has to end.
+        :param err: the USBError of the read
+        """
+        return self._recover(classify_error(err), err)
+
+    def handle_timeout(self):
+        """
+        Check the scan after a read timeout. Returns True if reading
+        should continue, False if the scan has ended.
+        """
+        if self._thread.shutdown.is_set():
+            return False
+        try:
+            status = self._device.send_message('?AISCAN:STATUS')
+        except IOError as err:
+            return self._recover(classify_error(err), err)
+        if status.endswith('=OVERRUN'):
+            return self._recover(OVERRUN, IOError('AISCAN overrun'))
+        return status.endswith('=RUNNING')
+
+    def _recover(self, kind, err):
+        t_error = time.time()
+        t_start = time.perf_counter()
+        recent = [recovery for recovery in self.recoveries
+                  if recovery.time > t_error - self.window]
+        dev = self._device
+        if kind == FATAL or len(recent) >= self.max_recoveries or \
+                self._thread.shutdown.is_set() or \
+                dev.scan_config.get('AISCAN:SAMPLES', '0') != '0':
+            return self._fail(err)
+        clock = self._thread.clock
+        settings = ['{0}={1}'.format(name, value)
+                    for name, value in dev.scan_config.items()]
+        try:
+            dev.send_message('AISCAN:STOP')
+            if kind == STALL:
+                self._thread.endpoint.clear_halt()
+            dev.flush_input_data()
+            dev.send_messages(settings)
+            t_before = time.monotonic()
+            dev.send_message('AISCAN:START')
+            t_armed = (t_before + time.monotonic()) / 2
+        except (IOError, usb.core.USBError) as error:
+            return self._fail(error)
+        # skip the scans the device clock acquired during the restart
+        start = clock.samples
+        scan = clock.scan_at(t_armed)
+        lost = 0
+        if scan is not None:
+            lost = max(int(math.ceil(scan)) * clock.channels - start, 0)
+        self._thread.data_buffer.skip(lost)
+        clock.skip(lost)
+        self.recoveries.append(Recovery(
+            t_error, kind, repr(err), (start, start + lost),
+            time.perf_counter() - t_start))
+        return True
+
+    def _fail(self, err):
+        """End the transfer with an error."""
+        self.error = err
+        self._thread.data_buffer.fail(err)
+        return False
@@ -0,0 +1,201 @@
+# coding=utf-8
+"""
+Host clock timestamps of continuous transfer samples.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import collections
+import time
+
+ClockEstimate = collections.namedtuple('ClockEstimate', [
+    'offset',     # host time of scan 0 in seconds (time.monotonic)
+    'period',     # estimated scan period in seconds
+    'rate',       # estimated scan rate in Hz
+    'drift_ppm',  # deviation of the rate from the nominal rate in ppm
+    'jitter',     # RMS residual of the fitted arrival times in seconds
+    'points',     # number of windows used by the fit
+])
+
+
+class ClockModel(object):
+    """
+    Online linear model of the device scan clock in host monotonic time,
+    t(scan) = offset + scan * period.
+
+    The acquisition thread reports the arrival time of every transfer
+    with add(). A transfer cannot arrive before its last scan has been
+    acquired, but USB scheduling and thread wake-ups delay it by a
+    varying amount. The model therefore keeps the earliest arrival
+    relative to the nominal clock in each window of interval seconds,
+    fits a least squares line through these minima and refits once
+    without the windows far above it (e.g. a stalled reading thread).
+    Each fit costs O(windows) Python operations once per interval; add()
+    costs a few float operations.
+
+    Timestamps of sample indices are computed by arithmetic on the
+    argument, so a numpy array of indices is converted in a single
+    vectorized expression.
+    """
+
+    def __init__(self, rate, channels=1, interval=1.0, windows=600):
+        """
+        :param rate: the nominal scan rate in Hz
+        :param channels: the number of channels per scan (default = 1)
+        :param interval: the window length in seconds (default = 1.0)
+        :param windows: the number of windows used by the fit, i.e. the
+        model follows changes of the drift over about windows * interval
+        seconds (default = 600)
+        """
+        self.nominal_rate = float(rate)
+        self.channels = channels
+        self.interval = interval
+        self.samples = 0
+        self._nominal_period = 1.0 / self.nominal_rate
+        self._minima = collections.deque(maxlen=windows)
+        self._window_end = None
+        self._window_min = None
+        # (offset, period), replaced as a whole for concurrent readers
+        self._line = None
+        self._estimate = None
+
+    def add(self, samples, t_arrival=None):
+        """
+        Account for a received transfer.
+        :param samples: the number of samples in the transfer
+        :param t_arrival: the time.monotonic() when the transfer was
+        received (default = None, now)
+        """
+        if t_arrival is None:
+            t_arrival = time.monotonic()
+        self.samples += samples
+        scan = self.samples // self.channels - 1
+        if scan < 0:
+            return
+        residual = t_arrival - scan * self._nominal_period
+        if self._window_min is None or residual < self._window_min[0]:
+            self._window_min = (residual, scan, t_arrival)
+        if self._window_end is None:
+            self._window_end = t_arrival + self.interval
+        elif t_arrival >= self._window_end:
+            self._minima.append(self._window_min[1:])
+            self._window_min = None
+            self._window_end = t_arrival + self.interval
+            self._fit()
+        if len(self._minima) < 2 and (self._line is None or
+                                      residual < self._line[0]):
+            # nominal rate until two windows are complete
+            self._line = (residual, self._nominal_period)
+
+    def skip(self, samples):
+        """
+        Account for samples lost without a transfer, e.g. while a scan
+        was restarted, to keep the stream index on the device time base.
+        :param samples: the number of lost samples
+        """
+        self.samples += samples
+
+    def scan_at(self, t):
+        """
+        Return the fractional scan index acquired at a host monotonic
+        time, or None before the first transfer.
+        :param t: the time.monotonic() value
+        """
+        if self._line is None:
+            return None
+        offset, period = self._line
+        return (t - offset) / period
+
+    def _fit(self):
+        points = list(self._minima)
+        if len(points) < 2:
+            return
+        offset, period = self._least_squares(points)
+        residuals = [t - offset - scan * period for scan, t in points]
+        ordered = sorted(residuals)
+        median = ordered[len(ordered) // 2]
+        spread = sorted(abs(r - median) for r in residuals)
+        limit = median + 3 * max(spread[len(spread) // 2], 1e-6)
+        inliers = [p for p, r in zip(points, residuals) if r <= limit]
+        if len(inliers) >= 2 and len(inliers) < len(points):
+            offset, period = self._least_squares(inliers)
+        residuals = [t - offset - scan * period for scan, t in inliers]
+        jitter = (sum(r * r for r in residuals) / len(residuals)) ** 0.5
+        self._line = (offset, period)
+        self._estimate = ClockEstimate(
+            offset, period, 1.0 / period,
+            (self._nominal_period / period - 1.0) * 1e6, jitter,
+            len(inliers))
+
+    @staticmethod
+    def _least_squares(points):
+        """Fit t = offset + scan * period, centered for precision."""
+        count = float(len(points))
+        mean_scan = sum(scan for scan, _ in points) / count
+        mean_t = sum(t for _, t in points) / count
+        sxx = sum((scan - mean_scan) ** 2 for scan, _ in points)
+        sxt = sum((scan - mean_scan) * (t - mean_t) for scan, t in points)
+        period = sxt / sxx
+        return mean_t - mean_scan * period, period
+
+    def estimate(self):
+        """
+        Return the current ClockEstimate, based on the nominal rate
+        until two windows are complete, or None before the first transfer.
+        """
+        if self._estimate is not None:
+            return self._estimate
+        if self._line is None:
+            return None
+        return ClockEstimate(self._line[0], self._nominal_period,
+                             self.nominal_rate, 0.0, 0.0, len(self._minima))
+
+    def scan_times(self, scan_index):
+        """
+        Return the host monotonic acquisition times of scan indices.
+        :param scan_index: an int or a numpy array of scan indices
+        """
+        if self._line is None:
+            raise ValueError('no transfer received yet')
+        offset, period = self._line
+        return offset + scan_index * period
+
+    def timestamps(self, sample_index):
+        """
+        Return the host monotonic acquisition times of stream sample
+        indices (e.g. DataBlock.sequence + numpy.arange(len(data))).
+        :param sample_index: an int or a numpy array of sample indices
+        """
+        return self.scan_times(sample_index // self.channels)
+
+    def block_times(self, block):
+        """
+        Return a numpy array with the acquisition time of every sample
+        of a DataBlock.
+        :param block: the DataBlock (sequence, data)
+        """
+        import numpy
+        return self.timestamps(numpy.arange(
+            block.sequence, block.sequence + len(block.data)))
@@ -0,0 +1,271 @@
+# coding=utf-8
+"""
+Asynchronous bulk transfer engine for continuous AISCAN acquisition.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import array
+import ctypes
+import errno
+import time
+from threading import Thread, Event
+from .metrics import AcquisitionMetrics
+from .timestamps import ClockModel
+from .utils import BufferOverflowError, usb
+
+# libusb_transfer_status codes
+TRANSFER_COMPLETED = 0
+TRANSFER_ERROR = 1
+TRANSFER_TIMED_OUT = 2
+TRANSFER_CANCELLED = 3
+TRANSFER_STALL = 4
+TRANSFER_NO_DEVICE = 5
+TRANSFER_OVERFLOW = 6
+
+_TRANSFER_ERRNO = {
+    TRANSFER_ERROR: errno.EIO,
+    TRANSFER_TIMED_OUT: errno.ETIMEDOUT,
+    TRANSFER_CANCELLED: errno.EAGAIN,
+    TRANSFER_STALL: errno.EIO,
+    TRANSFER_NO_DEVICE: errno.ENODEV,
+    TRANSFER_OVERFLOW: errno.EOVERFLOW,
+}
+
+_LIBUSB_TRANSFER_TYPE_BULK = 2
+
+
+class _Timeval(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_usec', ctypes.c_long)]
+
+
+class LibusbTransferQueue(object):
+    """
+    Queue of asynchronous bulk IN transfers on top of PyUSB's libusb 1.0
+    backend. Transfers complete in submission order and report back
+    through callback(slot, status, length) from within poll().
+    """
+
+    def __init__(self, endpoint, callback):
+        """
+        Allocate the transfer queue for an endpoint.
+        :param endpoint: the PyUSB bulk IN endpoint object
+        :param callback: completion function(slot, status, length)
+        """
+        from usb.backend import libusb1
+        device = endpoint.device
+        backend = device._ctx.backend
+        if not isinstance(backend, libusb1._LibUSB):
+            raise NotImplementedError(
+                'Asynchronous transfers require the libusb 1.0 backend')
+        device._ctx.setup_request(device, endpoint)
+        self._libusb1 = libusb1
+        self._lib = backend.lib
+        self._ctx = backend.ctx
+        self._handle = device._ctx.handle.handle
+        self._address = endpoint.bEndpointAddress
+        self._lib.libusb_cancel_transfer.argtypes = [
+            ctypes.POINTER(libusb1._libusb_transfer)]
+        self._lib.libusb_handle_events_timeout.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(_Timeval)]
+        self._callback = callback
+        self._c_callback = libusb1._libusb_transfer_cb_fn_p(self._complete)
+        self._transfers = {}
+        self.pending = 0
+
+    def submit(self, slot, buf, timeout):
+        """
+        Queue a bulk read into buf.
+        :param slot: identifier passed back to the completion callback
+        :param buf: the array to read into (must stay alive until completion)
+        :param timeout: the transfer timeout in ms
+        """
+        transfer_p = self._transfers.get(slot)
+        if transfer_p is None:
+            transfer_p = self._lib.libusb_alloc_transfer(0)
+            self._transfers[slot] = transfer_p
+        address, length = buf.buffer_info()
+        transfer = transfer_p.contents
+        transfer.dev_handle = self._handle
+        transfer.endpoint = self._address
+        transfer.type = _LIBUSB_TRANSFER_TYPE_BULK
+        transfer.timeout = timeout
+        transfer.buffer = address
+        transfer.length = length * buf.itemsize
+        transfer.user_data = slot
+        transfer.callback = self._c_callback
+        self._libusb1._check(self._lib.libusb_submit_transfer(transfer_p))
+        self.pending += 1
+
+    def poll(self, timeout):
+        """
+        Process completed transfers, waiting at most timeout seconds.
+        """
+        tv = _Timeval(int(timeout), int((timeout % 1) * 1e6))
+        self._libusb1._check(self._lib.libusb_handle_events_timeout(
+            self._ctx, ctypes.byref(tv)))
+
+    def cancel(self):
+        """Request cancellation of all pending transfers."""
+        for transfer_p in self._transfers.values():
+            # cancelling an idle transfer just returns an error code
+            self._lib.libusb_cancel_transfer(transfer_p)
+
+    def close(self):
+        """Free all transfers. No transfer may be pending."""
+        for transfer_p in self._transfers.values():
+            self._lib.libusb_free_transfer(transfer_p)
+        self._transfers.clear()
+
+    def _complete(self, transfer_p):
+        """libusb completion callback."""
+        transfer = transfer_p.contents
+        self.pending -= 1
+        self._callback(transfer.user_data, transfer.status,
+                       transfer.actual_length)
+
+
+class AsyncBulkReader(Thread):
+    """
+    Thread for continuous data retrieval that keeps several bulk transfers
+    in flight, so the device always has a queued request to fill while
+    completed packets are being copied into the buffer.
+    Drop-in replacement for PollingThread.
+    """
+
+    def __init__(self, endpoint, data_buf, packet_size, rate, queue_depth=4,
+                 queue_factory=None, metrics=None, clock=None):
+        """
+        :param endpoint: the bulk IN endpoint to read from
+        :param data_buf: the SampleRingBuffer receiving the samples
+        :param packet_size: the size of a single transfer in bytes
+        :param rate: the sample rate of the AISCAN command in Hz
+        :param queue_depth: number of transfers kept in flight (default = 4)
+        :param queue_factory: transfer queue class (default = None, use
+        the transfer_queue of the endpoint if it has one, otherwise
+        LibusbTransferQueue)
+        :param metrics: the AcquisitionMetrics to update; the latency of a
+        transfer is measured from its submission (default = None, create
+        new metrics)
+        :param clock: the ClockModel receiving the arrival times of the
+        transfers (default = None, create a new model)
+        """
+        super(AsyncBulkReader, self).__init__()
+        if queue_depth < 1:
+            raise ValueError('queue_depth must be at least 1')
+        self.endpoint = endpoint
+        self._packet_size = packet_size
+        self.data_buffer = data_buf
+        self.rate = rate
+        self.queue_depth = queue_depth
+        self.shutdown = Event()
+        self.new_data = Event()
+        # the exception that ended the transfer, raised by
+        # MCCDevice.stop_continuous_transfer
+        self.error = None
+        self.metrics = metrics or AcquisitionMetrics(data_buf, rate)
+        self.clock = clock or ClockModel(rate)
+        # functions called by this thread after new data was buffered
+        self.listeners = []
+        self._submitted = [0.0] * queue_depth
+        self._buffers = [array.array('H', [0]) * (packet_size // 2)
+                         for _ in range(queue_depth)]
+        self._views = [memoryview(buf) for buf in self._buffers]
+        if queue_factory is None:
+            queue_factory = getattr(endpoint, 'transfer_queue',
+                                    LibusbTransferQueue)
+        self._queue = queue_factory(endpoint, self._complete)
+        # later transfers wait behind the earlier ones in the queue
+        self._timeout = int(queue_depth * packet_size * 1e3 / 2 / rate) + 10
+
+    def run(self):
+        try:
+            for slot in range(self.queue_depth):
+                self._submit(slot)
+            while not self.shutdown.is_set():
+                self._queue.poll(0.1)
+            self._queue.cancel()
+            while self._queue.pending:
+                self._queue.poll(0.1)
+        except Exception as err:
+            if self.error is None:
+                self.error = err
+        finally:
+            self._queue.close()
+
+    def _notify(self):
+        """Notify waiting consumers and listeners of new data."""
+        self.new_data.set()
+        for listener in self.listeners:
+            listener()
+
+    def _submit(self, slot):
+        self._submitted[slot] = time.perf_counter()
+        self._queue.submit(slot, self._buffers[slot], self._timeout)
+
+    def _complete(self, slot, status, length):
+        """
+        Completion callback of the transfer queue. Exceptions do not
+        propagate through the libusb callback, so they end the transfer
+        and are kept in error.
+        """
+        try:
+            self._finish(slot, status, length)
+        except Exception as err:
+            if self.error is None:
+                self.error = err
+            self._notify()
+            self.shutdown.set()
+
+    def _finish(self, slot, status, length):
+        """Copy a finished transfer into the buffer and resubmit it."""
+        if length:
+            t_arrival = time.monotonic()
+            try:
+                self.data_buffer.write(self._views[slot][:length // 2])
+            except BufferOverflowError:
+                # the consumer gets the error after the buffered data
+                self._notify()
+                self.shutdown.set()
+                return
+            self.metrics.record_read(
+                length, time.perf_counter() - self._submitted[slot])
+            self.clock.add(length // 2, t_arrival)
+            self._notify()
+        if self.shutdown.is_set() or status == TRANSFER_CANCELLED:
+            return
+        if status == TRANSFER_COMPLETED or (status == TRANSFER_TIMED_OUT and
+                                            length):
+            self._submit(slot)
+        elif status == TRANSFER_TIMED_OUT:
+            # no more data from the device, same as PollingThread
+            self.metrics.record_timeout()
+            self.shutdown.set()
+        else:
+            self.metrics.record_error()
+            self.error = usb.core.USBError('Bulk transfer failed', status,
+                                           _TRANSFER_ERRNO.get(status))
+            self.shutdown.set()
@@ -0,0 +1,224 @@
+# coding=utf-8
+"""
+Software trigger with pre-trigger history for scan streams.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import collections
+import numpy
+from .processing import ScanDemultiplexer, as_samples
+
+TRIGGER_MODES = ('level', 'rising', 'falling', 'enter', 'leave')
+
+TriggerRecord = collections.namedtuple('TriggerRecord', 'scan_index data')
+TriggerRecord.__doc__ = """
+A triggered record: data is a (pre_scans + post_scans, channels) array of
+raw counts, data[pre_scans] is the trigger scan with stream index
+scan_index.
+"""
+
+
+class Trigger(object):
+    """
+    Software trigger on raw counts of one channel of a scan stream.
+
+    Conditions are evaluated vectorized per block; the state of the
+    previous scan is kept, so edges across block boundaries are found.
+    The last pre_scans scans are kept in a preallocated ring buffer, so
+    every record has the full pre-trigger history. The trigger re-arms
+    after the post-trigger part plus holdoff scans.
+
+    Modes:
+
+    * level: the value is at or above level
+    * rising / falling: the value crosses level upwards / downwards
+    * enter / leave: the value enters / leaves the window (low, high)
+    """
+
+    def __init__(self, channels, channel=0, mode='rising', level=None,
+                 window=None, pre_scans=1000, post_scans=1000, holdoff=0):
+        """
+        :param channels: the number of channels per scan
+        :param channel: the index of the trigger channel in the scan
+        (default = 0)
+        :param mode: one of 'level', 'rising', 'falling', 'enter' or
+        'leave' (default = 'rising')
+        :param level: the trigger level in counts for level and edge modes
+        :param window: (low, high) counts for the window modes
+        :param pre_scans: scans recorded before the trigger (default = 1000)
+        :param post_scans: scans recorded from the trigger on, including
+        the trigger scan (default = 1000)
+        :param holdoff: scans after a record before the trigger re-arms
+        (default = 0)
+        """
+        if mode not in TRIGGER_MODES:
+            raise ValueError('unknown trigger mode: {0}'.format(mode))
+        if mode in ('enter', 'leave'):
+            if window is None:
+                raise ValueError('window required for mode ' + mode)
+        elif level is None:
+            raise ValueError('level required for mode ' + mode)
+        if post_scans < 1 or pre_scans < 0:
+            raise ValueError('invalid record length')
+        self.channels = channels
+        self.channel = channel
+        self.mode = mode
+        self.level = level
+        self.window = window
+        self.pre_scans = pre_scans
+        self.post_scans = post_scans
+        self.holdoff = holdoff
+        self.triggers = 0
+        self._history = numpy.zeros((max(pre_scans, 1), channels),
+                                    dtype=numpy.uint16)
+        self._demux = ScanDemultiplexer(channels)
+        self._sequence = None
+        self.reset()
+
+    def reset(self):
+        """Discard history and pending records, e.g. after a data gap."""
+        self.scan_index = 0
+        self._filled = 0
+        self._hist_pos = 0
+        self._prev = None
+        self._armed_at = self.pre_scans
+        self._record = None
+        self._record_fill = 0
+        self._record_index = None
+        self._demux.reset()
+
+    def _condition(self, values):
+        """Return the trigger condition for each value."""
+        if self.mode in ('level', 'rising'):
+            return values >= self.level
+        if self.mode == 'falling':
+            return values <= self.level
+        low, high = self.window
+        inside = (values >= low) & (values <= high)
+        return inside if self.mode == 'enter' else ~inside
+
+    def feed(self, scans):
+        """
+        Process the next block of scans.
+        :param scans: (scans, channels) uint16 array, e.g. from
+        ScanDemultiplexer
+        :returns: list of completed TriggerRecords
+        """
+        records = []
+        count = len(scans)
+        base = self.scan_index
+        self._complete_record(scans, 0, records)
+        cond = self._condition(scans[:, self.channel])
+        if self.mode == 'level':
+            hits = numpy.flatnonzero(cond)
+        else:
+            before = numpy.empty(count, dtype=bool)
+            before[0] = cond[0] if self._prev is None else self._prev
+            before[1:] = cond[:-1]
+            hits = numpy.flatnonzero(cond & ~before)
+        if count:
+            self._prev = cond[-1]
+        while len(hits):
+            first = numpy.searchsorted(hits, self._armed_at - base)
+            if first == len(hits):
+                break
+            hit = int(hits[first])
+            self._start_record(scans, hit, base + hit)
+            self._complete_record(scans, hit, records)
+            hits = hits[first + 1:]
+        self._store_history(scans)
+        self.scan_index += count
+        return records
+
+    def _start_record(self, scans, hit, index):
+        """Begin a record for the trigger at scans[hit]."""
+        pre = self.pre_scans
+        record = numpy.empty((pre + self.post_scans, self.channels),
+                             dtype=numpy.uint16)
+        # pre-trigger scans from the history and the current block
+        from_block = min(hit, pre)
+        from_history = pre - from_block
+        if from_history:
+            record[:from_history] = self._last_history(from_history)
+        record[from_history:pre] = scans[hit - from_block:hit]
+        self._record = record
+        self._record_fill = pre
+        self._record_index = index
+        self._armed_at = index + self.post_scans + self.holdoff
+        self.triggers += 1
+
+    def _complete_record(self, scans, start, records):
+        """Copy post-trigger scans from scans[start:] into the record."""
+        if self._record is None:
+            return
+        take = min(len(self._record) - self._record_fill, len(scans) - start)
+        self._record[self._record_fill:self._record_fill + take] = \
+            scans[start:start + take]
+        self._record_fill += take
+        if self._record_fill == len(self._record):
+            records.append(TriggerRecord(self._record_index, self._record))
+            self._record = None
+
+    def _store_history(self, scans):
+        """Keep the last pre_scans scans in the history ring."""
+        size = len(self._history)
+        scans = scans[-size:]
+        count = len(scans)
+        pos = self._hist_pos
+        first = min(count, size - pos)
+        self._history[pos:pos + first] = scans[:first]
+        self._history[:count - first] = scans[first:]
+        self._hist_pos = (pos + count) % size
+        self._filled = min(self._filled + count, size)
+
+    def _last_history(self, count):
+        """Return the last count scans of the history in order."""
+        index = (self._hist_pos - count + numpy.arange(count)) % \
+            len(self._history)
+        return self._history[index]
+
+    def __call__(self, block):
+        """
+        Pipeline stage function: demultiplex a DataBlock of raw samples
+        and return the list of completed TriggerRecords, or None. A gap
+        in the sequence numbers resets the trigger.
+        """
+        data = as_samples(block.data)
+        sequence = block.sequence
+        if sequence != self._sequence:
+            # start or gap: resume at the next complete scan
+            skip = -sequence % self.channels
+            data = data[skip:]
+            sequence += skip
+            self.reset()
+            self.scan_index = sequence // self.channels
+            self._armed_at = self.scan_index + self.pre_scans
+        self._sequence = sequence + len(data)
+        records = []
+        for scans in self._demux.feed(data):
+            records.extend(self.feed(scans))
+        return records or None
@@ -0,0 +1,198 @@
+# coding=utf-8
+"""
+Runtime tuning of the transfer size of continuous transfers.
+
+Copyright (c) 2013, David Kiliani <mail@davidkiliani.de>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+  this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import collections
+
+OperatingPoint = collections.namedtuple('OperatingPoint', [
+    'packet_size',       # transfer size in bytes
+    'timeout',           # read timeout in ms
+    'latency',           # time to fill one transfer in seconds
+    'reads_per_second',  # measured read rate
+    'cpu_load',          # measured CPU time of the reading thread per second
+    'backlog',           # fraction of reads served from the device FIFO
+    'changes',           # number of transfer size changes so far
+])
+
+# default unit of the transfer sizes in bytes
+_GRANULARITY = 64
+
+
+class TransferTuner(object):
+    """
+    Adapts the transfer size and read timeout of a continuous transfer
+    at runtime, so a single configuration serves slow logging and fast
+    streaming.
+
+    The transfer size starts at target_latency worth of data for the scan
+    rate and channel count. Every interval seconds the tuner compares the
+    measured CPU time of the reading thread with cpu_budget and sizes the
+    transfers for 80 % of the budget (the CPU load per second falls about
+    linearly with the number of reads). Reads that return a full transfer
+    much faster than the scan can fill it were served from the device
+    FIFO, i.e. the reader lags behind; the transfer size is then doubled
+    until the backlog is gone. When neither limit applies, the size
+    shrinks back towards the latency target. The timeout allows twice the
+    fill time of a transfer. Transfer sizes are multiples of the bulk
+    endpoint packet size, so a read never ends within a packet.
+
+    Pass the tuner to MCCDevice.start_continuous_transfer and query
+    operating_point() for the chosen configuration.
+    """
+
+    def __init__(self, target_latency=0.05, cpu_budget=0.05, interval=0.5,
+                 min_packet_size=_GRANULARITY, max_packet_size=1 << 20):
+        """
+        :param target_latency: the desired time in seconds between the
+        acquisition of a sample and its delivery (default = 0.05)
+        :param cpu_budget: the CPU time the reading thread may use per
+        second (default = 0.05, i.e. 5 % of a core)
+        :param interval: the time between adjustments in seconds
+        (default = 0.5)
+        :param min_packet_size: the smallest transfer size in bytes; the
+        device sends up to wMaxPacketSize bytes at once, so smaller sizes
+        need a transfer mode that sends single samples (default = 64)
+        :param max_packet_size: the largest transfer size in bytes; it is
+        further limited to a quarter of the buffer (default = 1 MiB)
+        """
+        if target_latency <= 0 or cpu_budget <= 0:
+            raise ValueError('target_latency and cpu_budget must be positive')
+        self.target_latency = target_latency
+        self.cpu_budget = cpu_budget
+        self.interval = interval
+        self.min_packet_size = min_packet_size
+        self.max_packet_size = max_packet_size
+        # the largest transfer size for the current buffer
+        self.size_limit = max_packet_size
+        self.granularity = _GRANULARITY
+        self.byte_rate = None
+        self.packet_size = None
+        self.timeout = None
+        self.changes = 0
+        self._point = None
+
+    def _round(self, size, limit, granularity=None):
+        """
+        Round a size in bytes up to a multiple of the granularity, at least
+        min_packet_size and at most the limit rounded down.
+        """
+        step = granularity or self.granularity
+        size = max(size, self.min_packet_size)
+        size = int(size + step - 1) // step * step
+        return min(size, max(int(limit) // step * step, step))
+
+    def initial_packet_size(self, rate, channels=1, granularity=None):
+        """
+        Return the transfer size meeting the latency target.
+        :param rate: the scan rate in Hz
+        :param channels: the number of channels per scan (default = 1)
+        :param granularity: the bulk endpoint packet size in bytes
+        (default = None, the granularity of the last start() or 64)
+        """
+        return self._round(2.0 * rate * channels * self.target_latency,
+                           self.max_packet_size, granularity)
+
+    def start(self, rate, channels, capacity, granularity=_GRANULARITY):
+        """
+        Reset to the initial operating point, called when the transfer
+        starts.
+        :param rate: the scan rate in Hz
+        :param channels: the number of channels per scan
+        :param capacity: the buffer capacity in samples
+        :param granularity: the bulk endpoint packet size (wMaxPacketSize)
+        in bytes, all transfer sizes are multiples of it (default = 64)
+        """
+        self.granularity = granularity
+        self.byte_rate = 2.0 * rate * channels
+        # at most a quarter of the buffer
+        limit = min(self.max_packet_size, capacity // 2)
+        self.size_limit = max(limit // granularity * granularity,
+                              granularity)
+        self.changes = 0
+        self._set_size(min(self.initial_packet_size(rate, channels),
+                           self.size_limit))
+        self._reset(None)
+        self._point = OperatingPoint(
+            self.packet_size, self.timeout,
+            self.packet_size / self.byte_rate, 0.0, 0.0, 0.0, 0)
+
+    def _set_size(self, size):
+        self.packet_size = size
+        self.timeout = int(2e3 * size / self.byte_rate) + 10
+
+    def _reset(self, now):
+        self._t_start = now
+        self._reads = 0
+        self._fast = 0
+        self._cpu = 0.0
+
+    def record(self, length, duration, cpu, now):
+        """
+        Account for a read call of the reading thread.
+        :param length: the number of bytes received
+        :param duration: the duration of the read call in seconds
+        :param cpu: the CPU time of the reading thread for this read,
+        including buffering the data, in seconds
+        :param now: the current time.perf_counter()
+        """
+        if self._t_start is None:
+            self._t_start = now
+        self._reads += 1
+        self._cpu += cpu
+        if length == self.packet_size and \
+                duration < 0.25 * length / self.byte_rate:
+            self._fast += 1
+        if now - self._t_start >= self.interval:
+            self._adapt(now - self._t_start)
+            self._reset(now)
+
+    def _adapt(self, elapsed):
+        size = self.packet_size
+        cpu_load = self._cpu / elapsed
+        backlog = self._fast / float(self._reads)
+        # the CPU load scales with the number of reads per second; aim
+        # below the budget to avoid toggling between two sizes
+        target = max(self.initial_packet_size(self.byte_rate / 2.0),
+                     size * cpu_load / (0.8 * self.cpu_budget))
+        if backlog > 0.5:
+            target = max(target, 2 * size)
+        target = self._round(target, self.size_limit)
+        if target > 1.25 * size or target < 0.8 * size:
+            self._set_size(target)
+            self.changes += 1
+        self._point = OperatingPoint(
+            self.packet_size, self.timeout,
+            self.packet_size / self.byte_rate, self._reads / elapsed,
+            cpu_load, backlog, self.changes)
+
+    def operating_point(self):
+        """
+        Return the current OperatingPoint with the measurements of the
+        last interval, or None before the transfer started.
+        """
+        return self._point
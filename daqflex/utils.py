@@ -29,14 +29,587 @@ POSSIBILITY OF SUCH DAMAGE.
 """
 
 import array
+import collections
+import ctypes
 import errno
-from threading import Thread, Event
-import usb
+import importlib
+import time
+import weakref
+from threading import Thread, Event, Condition
+from .metrics import AcquisitionMetrics
+from .timestamps import ClockModel
+
+# overflow policies of SampleRingBuffer
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+BLOCK = 'block'
+RAISE = 'raise'
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK, RAISE)
+
+DataBlock = collections.namedtuple('DataBlock', 'sequence data')
+DataBlock.__doc__ = """
+Contiguous samples of a continuous transfer. sequence is the stream
+index of the first sample, counting all samples acquired by the device
+including lost ones.
+"""
+
+
+class BufferOverflowError(IOError):
+    """The consumer of a SampleRingBuffer fell behind the producer."""
+
+
+class LazyModule(object):
+    """
+    Placeholder for a module that is imported on first attribute access,
+    so that importing daqflex does not require or load the USB stack.
+    """
+
+    def __init__(self, name, submodules=()):
+        """
+        :param name: the name of the module
+        :param submodules: submodules to import together with the module
+        """
+        self.__name = name
+        self.__submodules = submodules
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name)
+        for submodule in self.__submodules:
+            importlib.import_module(submodule)
+        # later lookups are served directly from the instance dict
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+usb = LazyModule('usb', ('usb.core', 'usb.util', 'usb.control'))
+
+
+class _BufferWindow(object):
+    """
+    Byte range of a writable buffer, presented with the array interface
+    (buffer_info/itemsize) that PyUSB backends use for reading in place.
+    """
+    itemsize = 1
+
+    def __init__(self, view):
+        self._length = len(view)
+        # address of the first byte, without creating a ctypes array type
+        self._address = ctypes.addressof(ctypes.c_char.from_buffer(view))
+
+    def buffer_info(self):
+        return self._address, self._length
+
+
+# in-place read functions of PyUSB endpoints, None if unsupported
+_in_place_readers = weakref.WeakKeyDictionary()
+
+
+def _in_place_reader(endpoint):
+    """
+    Return a function(view, timeout) reading from a PyUSB endpoint
+    directly into a buffer, or None if the PyUSB internals this relies on
+    (the resource manager of the device and the bulk_read of its backend)
+    are missing.
+    """
+    device = getattr(endpoint, 'device', None)
+    ctx = getattr(device, '_ctx', None)
+    backend = getattr(ctx, 'backend', None)
+    if not (hasattr(ctx, 'setup_request') and hasattr(ctx, 'handle') and
+            hasattr(backend, 'bulk_read')):
+        return None
+
+    def read(view, timeout):
+        intf, ep = ctx.setup_request(device, endpoint)
+        return backend.bulk_read(ctx.handle, ep.bEndpointAddress,
+                                 intf.bInterfaceNumber, _BufferWindow(view),
+                                 timeout)
+    return read
+
+
+def read_into(endpoint, view, timeout):
+    """
+    Read from a bulk IN endpoint directly into a region of a buffer.
+    PyUSB has no public API for this, so the backend is called directly
+    where its internals are as expected; otherwise the data is read with
+    endpoint.read() and copied.
+    :param endpoint: the PyUSB endpoint (or any object with a
+    readinto(view, timeout) method)
+    :param view: writable byte memoryview receiving the data
+    :param timeout: the read timeout in ms
+    :returns: the number of bytes read
+    """
+    if hasattr(endpoint, 'readinto'):
+        return endpoint.readinto(view, timeout)
+    try:
+        reader = _in_place_readers[endpoint]
+    except KeyError:
+        reader = _in_place_readers[endpoint] = _in_place_reader(endpoint)
+    if reader is not None:
+        try:
+            return reader(view, timeout)
+        except (AttributeError, TypeError):
+            # the backend does not take the buffer window
+            _in_place_readers[endpoint] = None
+    data = endpoint.read(len(view), timeout)
+    view[:len(data)] = data
+    return len(data)
+
+
+class SampleRingBuffer(object):
+    """
+    Fixed-size, preallocated ring buffer for raw uint16 samples.
+
+    The storage is allocated once and never grows. Positions are tracked
+    as absolute sample counters (``head`` = total samples written,
+    ``tail`` = total samples consumed), so one producer thread and one
+    consumer thread can share the buffer without copying packets around.
+
+    If the producer overruns the consumer, the overflow policy decides:
+    DROP_OLDEST overwrites the oldest unread samples, DROP_NEWEST discards
+    the incoming ones, BLOCK makes the producer wait for free space and
+    RAISE stops accepting data. Lost samples are counted in ``dropped``
+    and listed in ``gaps`` as (start, end) ranges of stream indices.
+    The stream index (``sequence``) counts all samples given to write(),
+    so it equals the device sample number.
+    """
+    typecode = 'H'
+
+    def __init__(self, capacity, overflow=DROP_OLDEST, block_timeout=None):
+        """
+        Allocate the sample storage.
+        :param capacity: the maximum number of samples in the buffer
+        :param overflow: the overflow policy, one of DROP_OLDEST,
+        DROP_NEWEST, BLOCK or RAISE (default = DROP_OLDEST)
+        :param block_timeout: maximum time in seconds a write waits with
+        the BLOCK policy before failing like RAISE
+        (default = None, wait indefinitely)
+        """
+        if capacity <= 0:
+            raise ValueError('capacity must be positive')
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy: {0}'.format(overflow))
+        self.capacity = int(capacity)
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self._data = array.array(self.typecode, [0]) * self.capacity
+        self._view = memoryview(self._data)
+        self._lock = Condition()
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self.gaps = []
+        self.error = None
+        self._write_end = 0
+        self._closed = False
+        # stream index = position + offset, the offset grows at every
+        # DROP_NEWEST gap; pending changes as (position, offset)
+        self._offsets = collections.deque()
+        self._tail_offset = 0
+        self._head_offset = 0
+        # all offset changes still in the storage, for stream_index()
+        self._history = collections.deque()
+        self._base_offset = 0
+        # read position of the last peek, consume() counts from there
+        self._peek_start = None
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def __bool__(self):
+        return self.head != self.tail
+
+    __nonzero__ = __bool__
+
+    @property
+    def free(self):
+        """Number of samples that can be written without dropping data."""
+        return self.capacity - len(self)
+
+    @property
+    def sequence(self):
+        """Stream index of the next unread sample."""
+        with self._lock:
+            return self.tail + self._tail_offset
+
+    def close(self):
+        """
+        Release a producer blocked by the BLOCK policy; further writes
+        drop the newest samples instead of waiting. Unread data stays
+        readable.
+        """
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+    def write(self, samples):
+        """
+        Copy samples into the buffer, applying the overflow policy if
+        the buffer is full.
+        :param samples: uint16 samples (array, memoryview or any object
+        supporting the buffer protocol with item size 2)
+        :returns: the number of samples written
+        """
+        src = memoryview(samples)
+        if src.format != self.typecode:
+            src = src.cast('B').cast(self.typecode)
+        count = len(src)
+        if self.overflow != DROP_OLDEST:
+            count = self._reserve(count)
+            src = src[:count]
+        elif count > self.capacity:
+            # only the newest samples fit into the buffer
+            skip = count - self.capacity
+            src = src[skip:]
+            with self._lock:
+                self.head += skip
+            count = self.capacity
+        # samples up to this index may be overwritten while copying
+        self._write_end = self.head + count
+        pos = self.head % self.capacity
+        first = min(count, self.capacity - pos)
+        self._view[pos:pos + first] = src[:first]
+        if first < count:
+            self._view[:count - first] = src[first:]
+        self.commit(count)
+        return count
+
+    def write_view(self, count):
+        """
+        Return a writable memoryview of count samples at the write
+        position, so that a producer can read data straight into the
+        buffer and publish it with commit(). Returns None if the samples
+        have to go through write() instead: if they would wrap around the
+        end of the storage, or not fit with a policy other than
+        DROP_OLDEST.
+        :param count: the number of samples
+        """
+        with self._lock:
+            pos = self.head % self.capacity
+            if self.error is not None or count > self.capacity - pos:
+                return None
+            if self.overflow != DROP_OLDEST and \
+                    count > self.capacity - (self.head - self.tail):
+                return None
+            # samples up to this index may be overwritten from now on
+            self._write_end = self.head + count
+            return self._view[pos:pos + count]
+
+    def commit(self, count):
+        """
+        Publish samples copied to the write position, e.g. into the view
+        returned by write_view().
+        :param count: the number of samples
+        """
+        with self._lock:
+            self.head += count
+            self._drop_unread(self.head - self.capacity)
+
+    def _reserve(self, count):
+        """
+        Apply the DROP_NEWEST, BLOCK or RAISE policy to a write of count
+        samples and return the number of samples to store.
+        """
+        with self._lock:
+            if self.error is not None:
+                raise self.error
+            free = self.capacity - (self.head - self.tail)
+            if count > free and self.overflow == BLOCK and \
+                    count <= self.capacity:
+                deadline = None if self.block_timeout is None else \
+                    time.time() + self.block_timeout
+                while count > free and not self._closed:
+                    remaining = None if deadline is None else \
+                        deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+                    free = self.capacity - (self.head - self.tail)
+            if count <= free:
+                return count
+            if self.overflow == DROP_NEWEST or self._closed:
+                # the kept samples end at this position
+                self._skip(self.head + free, count - free)
+                self.dropped += count - free
+                return free
+            self.error = BufferOverflowError(
+                'Buffer overflow: {0} samples do not fit, {1} free'.format(
+                    count, free))
+            raise self.error
+
+    def skip(self, count):
+        """
+        Advance the stream index by samples that never reached the
+        buffer (e.g. while a scan was restarted). They are listed in
+        gaps, but not counted as dropped.
+        :param count: the number of lost samples
+        """
+        if count > 0:
+            with self._lock:
+                self._skip(self.head, count)
+
+    def fail(self, error):
+        """
+        End the stream with an error; readers get it after the buffered
+        data, as with the RAISE policy.
+        :param error: the exception to raise
+        """
+        with self._lock:
+            self.error = error
+            self._lock.notify_all()
+
+    def _skip(self, position, count):
+        """
+        Advance the stream index by count samples after a position, must
+        be called with the lock held.
+        """
+        start = position + self._head_offset
+        self._add_gap(start, start + count)
+        self._head_offset += count
+        for changes in (self._offsets, self._history):
+            if changes and changes[-1][0] == position:
+                changes[-1] = (position, self._head_offset)
+            else:
+                changes.append((position, self._head_offset))
+        history = self._history
+        while history and history[0][0] <= self.head - self.capacity:
+            self._base_offset = history.popleft()[1]
+        if position == self.tail:
+            # no unread samples before the gap
+            self._advance_tail(position)
+
+    def _drop_unread(self, end):
+        """
+        Discard the unread samples before position end as lost, must be
+        called with the lock held.
+        """
+        count = end - self.tail
+        if count > 0:
+            start = self.tail + self._tail_offset
+            self._add_gap(start, start + count)
+            self.dropped += count
+            self._advance_tail(end)
+
+    def _add_gap(self, start, end):
+        """Record lost stream indices, merging adjacent ranges."""
+        if self.gaps and self.gaps[-1][1] == start:
+            self.gaps[-1] = (self.gaps[-1][0], end)
+        else:
+            self.gaps.append((start, end))
+
+    def _advance_tail(self, tail):
+        """Move the read position, must be called with the lock held."""
+        self.tail = tail
+        while self._offsets and self._offsets[0][0] <= tail:
+            self._tail_offset = self._offsets.popleft()[1]
+        self._lock.notify_all()
+
+    def peek(self, count=None):
+        """
+        Return views of unread samples without copying or consuming them.
+        The result is a tuple of one or two memoryviews of contiguous
+        regions (two if the data wraps around the end of the buffer).
+        The views stay valid until the samples are consumed or overwritten
+        by an overrun; use numpy.frombuffer() to get ndarray views.
+        :param count: the maximum number of samples (default = None, all)
+        """
+        with self._lock:
+            tail = self._peek_start = self.tail
+            available = self.head - tail
+        if count is None or count > available:
+            count = available
+        return self.views(tail, count)
+
+    def peek_block(self, count=None):
+        """
+        Return views of unread samples up to the next gap like peek(),
+        as a DataBlock with the stream index of the first sample.
+        :param count: the maximum number of samples (default = None, all
+        contiguous samples)
+        """
+        with self._lock:
+            tail = self._peek_start = self.tail
+            available = self._contiguous(tail)
+            sequence = tail + self._tail_offset
+        if count is not None and count < available:
+            available = count
+        return DataBlock(sequence, self.views(tail, available))
+
+    def _contiguous(self, tail):
+        """
+        Number of unread samples before the next gap, must be called
+        with the lock held.
+        """
+        available = self.head - tail
+        if self._offsets:
+            available = min(available, self._offsets[0][0] - tail)
+        return available
+
+    def views(self, start, count):
+        """
+        Return views of the samples with absolute indices
+        start ... start + count - 1, independent of the read position.
+        This allows additional readers (e.g. a recorder) to follow the
+        stream with their own position. Samples older than
+        head - capacity have been overwritten; check with is_valid()
+        after processing the views.
+        :param start: the absolute index of the first sample
+        :param count: the number of samples
+        """
+        pos = start % self.capacity
+        first = min(count, self.capacity - pos)
+        if first == count:
+            return (self._view[pos:pos + count],)
+        return self._view[pos:], self._view[:count - first]
+
+    def stream_index(self, position):
+        """
+        Return the stream index of the sample at an absolute position
+        (see views), valid for positions from oldest on.
+        :param position: the absolute index of the sample
+        """
+        with self._lock:
+            offset = self._base_offset
+            for start, change in self._history:
+                if start > position:
+                    break
+                offset = change
+            return position + offset
+
+    def next_gap(self, position):
+        """
+        Return the absolute position of the first sample after a gap in
+        the stream indices that follows position, or None.
+        :param position: the absolute index of a sample
+        """
+        with self._lock:
+            for start, _ in self._history:
+                if start > position:
+                    return start
+        return None
+
+    @property
+    def oldest(self):
+        """
+        Absolute index of the oldest sample that is not (being)
+        overwritten by the producer.
+        """
+        return max(self._write_end - self.capacity, 0)
+
+    def is_valid(self, start):
+        """
+        Check whether the sample with absolute index start (and all later
+        ones) have not been overwritten yet.
+        """
+        return start >= self.oldest
+
+    def consume(self, count):
+        """
+        Mark samples as read, e.g. after processing the views from peek().
+        The count is relative to the read position of the last peek, so
+        samples dropped by an overrun meanwhile are not consumed twice.
+        Peeked samples that were overwritten before this call are listed
+        in gaps; check is_valid() before consuming to detect them.
+        :param count: the number of samples to discard
+        """
+        start, self._peek_start = self._peek_start, None
+        if start is None:
+            start = self.tail
+        self._finish_read(start, count)
+
+    def _finish_read(self, start, count):
+        """
+        Consume the samples start ... start + count - 1 after copying or
+        processing them and return the number of leading samples that
+        were overwritten meanwhile. These are recorded as lost, unless
+        an overrun already did so.
+        """
+        lost = min(max(self.oldest - start, 0), count)
+        with self._lock:
+            self._drop_unread(start + lost)
+            end = min(start + count, self.head)
+            if end > self.tail:
+                self._advance_tail(end)
+        return lost
+
+    def read(self, count=None):
+        """
+        Copy unread samples out of the buffer into a new array and
+        consume them.
+        :param count: the maximum number of samples (default = None, all)
+        """
+        data = array.array(self.typecode)
+        with self._lock:
+            start = self.tail
+            available = self.head - start
+        if count is not None and count < available:
+            available = count
+        for view in self.views(start, available):
+            data.frombytes(view.cast('B'))
+        del data[:self._finish_read(start, available)]
+        if not data:
+            self._raise_error()
+        return data
+
+    def read_block(self, count=None):
+        """
+        Copy unread samples up to the next gap into a new array, consume
+        them and return them as a DataBlock with their stream index.
+        Call again to get the data after a gap.
+        :param count: the maximum number of samples (default = None, all
+        contiguous samples)
+        """
+        with self._lock:
+            tail = self.tail
+            available = self._contiguous(tail)
+            sequence = tail + self._tail_offset
+        if count is not None and count < available:
+            available = count
+        data = array.array(self.typecode)
+        for view in self.views(tail, available):
+            data.frombytes(view.cast('B'))
+        lost = self._finish_read(tail, available)
+        if lost:
+            # overwritten while copying, the rest follows the gap
+            del data[:lost]
+            sequence += lost
+        if not data:
+            self._raise_error()
+        return DataBlock(sequence, data)
+
+    def _raise_error(self):
+        """Raise the overflow error once all data before it was read."""
+        if self.error is not None and not self:
+            raise self.error
+
+    def readinto(self, buf):
+        """
+        Copy unread samples into a preallocated buffer and consume them.
+        Handles the wrap-around case without intermediate copies.
+        :param buf: writable uint16 buffer (e.g. array or numpy array)
+        :returns: the number of samples copied
+        """
+        dst = memoryview(buf).cast('B').cast(self.typecode)
+        with self._lock:
+            start = self.tail
+            available = min(self.head - start, len(dst))
+        pos = 0
+        for view in self.views(start, available):
+            dst[pos:pos + len(view)] = view
+            pos += len(view)
+        lost = self._finish_read(start, pos)
+        if lost:
+            # drop the samples overwritten while copying
+            dst[:pos - lost] = dst[lost:pos]
+            pos -= lost
+        if not pos:
+            self._raise_error()
+        return pos
 
 
 class PollingThread(Thread):
     """Thread for asynchronous, continuous data retrieval."""
-    def __init__(self, endpoint, data_buf, packet_size, rate):
+    def __init__(self, endpoint, data_buf, packet_size, rate, metrics=None,
+                 clock=None, tuner=None):
         super(PollingThread, self).__init__()
         self.endpoint = endpoint
         self._packet_size = packet_size
@@ -44,21 +617,73 @@ class PollingThread(Thread):
         self.rate = rate
         self.shutdown = Event()
         self.new_data = Event()
+        self.metrics = metrics or AcquisitionMetrics(data_buf, rate)
+        self.clock = clock or ClockModel(rate)
+        # a started TransferTuner choosing the size of each read
+        self.tuner = tuner
+        # a StreamSupervisor handling read errors, set by attach()
+        self.supervisor = None
+        # functions called by this thread after new data was buffered
+        self.listeners = []
 
     def run(self):
         timeout = int(self._packet_size * 1e3 / 2 / self.rate) + 10
+        tuner = self.tuner
+        size = tuner.size_limit if tuner else self._packet_size
+        # packets are read straight into the ring buffer; reads wrapping
+        # around its end or overflowing it go through a single packet
+        # buffer, and write() applies the overflow policy
+        packet = array.array('H', [0]) * (size // 2)
+        packet_view = memoryview(packet)
+        byte_view = packet_view.cast('B')
+        write_view = getattr(self.data_buffer, 'write_view', None)
+        metrics = self.metrics
+        clock = self.clock
         while not self.shutdown.is_set():
-            packet = None
+            length = 0
+            if tuner is not None:
+                size, timeout = tuner.packet_size, tuner.timeout
+                t_cpu = time.thread_time()
+            t_read = time.perf_counter()
+            region = write_view(size // 2) if write_view else None
+            target = byte_view[:size] if region is None else region.cast('B')
             try:
-                packet = self.endpoint.read(self._packet_size, timeout)
+                length = read_into(self.endpoint, target, timeout)
+                t_arrival = time.monotonic()
             except usb.core.USBError as err:
                 if err.errno != errno.ETIMEDOUT:
-                    raise err
-            if (packet is None) or (len(packet) == 0):
+                    metrics.record_error()
+                    if self.supervisor is None:
+                        raise err
+                    if self.supervisor.handle_error(err):
+                        continue
+                    self._notify()
+                    break
+            if not length:
+                metrics.record_timeout()
+                if self.supervisor is not None and \
+                        self.supervisor.handle_timeout():
+                    continue
                 break
-            # convert to uint16 and put whole packet into buffer
-            data = array.array("H")
-            data.fromstring(packet)
-            self.data_buffer.append(data)
-            # notify listeners of new data
-            self.new_data.set()
\ No newline at end of file
+            try:
+                if region is None:
+                    self.data_buffer.write(packet_view[:length // 2])
+                else:
+                    self.data_buffer.commit(length // 2)
+            except BufferOverflowError:
+                # the consumer gets the error after the buffered data
+                self._notify()
+                break
+            t_done = time.perf_counter()
+            metrics.record_read(length, t_done - t_read)
+            clock.add(length // 2, t_arrival)
+            self._notify()
+            if tuner is not None:
+                tuner.record(length, t_done - t_read,
+                             time.thread_time() - t_cpu, t_done)
+
+    def _notify(self):
+        """Notify waiting consumers and listeners of new data."""
+        self.new_data.set()
+        for listener in self.listeners:
+            listener()
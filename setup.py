@@ -29,8 +29,8 @@ setup(
     keywords='mmc daqflex measurement computing usb driver',
     license='BSD',
     install_requires=[
-                      'setuptools',
                       'pyusb',
+                      'numpy',
     ],
 )
 